@@ -6,64 +6,256 @@ from builtins import str
 from builtins import range
 import os
 import os.path
-import scipy.signal
-import scipy.io.wavfile
+import argparse
+import functools
+import itertools
+from collections import namedtuple
 import numpy as np
 import hashlib
+import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import audio_wav_utils
+import common_utils
 
 DEFAULT_SAMPLE_RATE = 16000
+# Where cache_stimulus keeps generated test files, and the total size it is
+# allowed to grow to before the least recently used entries are deleted
+STIMULUS_CACHE_DIR = os.environ.get("ATT_STIMULUS_CACHE_DIR",
+                                    os.path.join(audio_wav_utils.AUDIO_CACHE_DIR, "stimuli"))
+STIMULUS_CACHE_MAX_BYTES = int(os.environ.get("ATT_STIMULUS_CACHE_MAX_BYTES", 4 * 2**30))
 SYSTEM_DELAY_SAMPLES = 40
+# Number of samples per channel converted and written at a time by write_data
+WRITE_BLOCK_SAMPLES = 2**16
+# Fraction of non-zero taps above which SparseFilter.apply uses FFT
+# convolution instead of adding in one delayed copy of the input per tap
+SPARSE_FILTER_MAX_DENSITY = 0.01
+# Block and partition length in samples used when streaming echo scenarios
+ECHO_BLOCK_SAMPLES = 2**12
+# Samples per independent random stream in get_noise. Changing this changes
+# the noise generated for every seed.
+NOISE_BLOCK_SAMPLES = 2**16
+# Length of the band-pass FIR used for streamed band-limited noise
+BAND_PASS_TAP_COUNT = 1025
+# Ratio of full scale to RMS of streamed band-limited noise at 0 dB. Peaks
+# beyond full scale (probability about 2e-9 per sample, roughly one sample
+# every 9 hours at 16 kHz) are clipped.
+BAND_LIMITED_NOISE_CREST_FACTOR = 6.0
 
 
-def get_magnitude(freq, X, Fs, tolerance_hz, normalise=False):
-    X = np.abs(X)
-    i = int(2 * freq * len(X) / Fs)
-    tol_i = int(2 * tolerance_hz * len(X) / Fs)
-    normalisation_factor = 1
-    if normalise:
-        normalisation_factor = 1.0 / len(X)
-    return np.max(X[i - tol_i:i + tol_i]) * normalisation_factor
+ToneMagnitudes = namedtuple('ToneMagnitudes', ['magnitudes', 'suppressed_magnitude', 'suppressed_frequency'])
 
 
-def get_suppressed_magnitude(frequencies, X, Fs, tolerance_hz,
-                             normalise=False, band_min=0, band_max=None):
+def _frequency_bin(freq, X_length, Fs):
+    return (2 * np.asarray(freq, dtype=np.float64) * X_length / Fs).astype(np.int64)
+
+
+def get_tone_magnitudes(frequencies, X, Fs, tolerance_hz, normalise=False,
+                        band_min=0, band_max=None):
+    """ Measures many tones in one or more spectra at once.
+
+    X is a one-sided spectrum with bins along its last axis, or a batch of
+    them, e.g. (channels, frames, bins). Its magnitude is taken once and
+    every tone and the suppressed band are found with vectorised gathers
+    and masks.
+
+    Returns a ToneMagnitudes of:
+      magnitudes: (..., frequencies) peak magnitude within tolerance_hz of
+        each frequency, as get_magnitude
+      suppressed_magnitude: (...) peak magnitude between band_min and
+        band_max away from all of the frequencies, as
+        get_suppressed_magnitude
+      suppressed_frequency: (...) frequency in Hz of that peak """
     if not band_max:
         band_max = Fs // 2
     X = np.abs(X)
-    tol_i = int(2 * tolerance_hz * len(X) / Fs)
-    min_i = int(2 * band_min * len(X) / Fs)
-    max_i = int(2 * band_max * len(X) / Fs)
-    X_nulled = np.array(X)
-    X_nulled[:min_i] = 0
-    X_nulled[max_i:] = 0
-    for freq in frequencies:
-        i = int(2 * freq * len(X) / Fs)
-        X_nulled[i - tol_i:i + tol_i] = 0
+    X_length = X.shape[-1]
+    tol_i = int(2 * tolerance_hz * X_length / Fs)
     normalisation_factor = 1
     if normalise:
-        normalisation_factor = 1.0 / len(X)
-    return np.max(X_nulled) * normalisation_factor,\
-           int(np.argmax(X_nulled) / (2.0 * len(X) / Fs))
+        normalisation_factor = 1.0 / X_length
+
+    # Gather a window of bins around every tone and take each one's peak
+    window_starts = _frequency_bin(frequencies, X_length, Fs) - tol_i
+    windows = window_starts[:, np.newaxis] + np.arange(max(2 * tol_i, 1))
+    windows = np.clip(windows, 0, X_length - 1)
+    magnitudes = np.max(X[..., windows], axis=-1) * normalisation_factor
+
+    # Mark the bins outside the band or near a tone, by counting the tone
+    # windows starting and ending at each bin
+    window_edges = np.zeros(X_length + 1, dtype=np.int64)
+    np.add.at(window_edges, np.clip(window_starts, 0, X_length), 1)
+    np.add.at(window_edges, np.clip(window_starts + 2 * tol_i, 0, X_length), -1)
+    suppressed = np.cumsum(window_edges[:-1]) > 0
+    suppressed[:_frequency_bin(band_min, X_length, Fs)] = True
+    suppressed[_frequency_bin(band_max, X_length, Fs):] = True
+
+    X_nulled = np.where(suppressed, 0, X)
+    peak_bins = np.argmax(X_nulled, axis=-1)
+    suppressed_magnitude = np.take_along_axis(X_nulled, peak_bins[..., np.newaxis], axis=-1)[..., 0]
+    suppressed_frequency = (peak_bins / (2.0 * X_length / Fs)).astype(np.int64)
+    return ToneMagnitudes(magnitudes, suppressed_magnitude * normalisation_factor,
+                          suppressed_frequency)
+
+
+def get_magnitude(freq, X, Fs, tolerance_hz, normalise=False):
+    return get_tone_magnitudes([freq], X, Fs, tolerance_hz, normalise).magnitudes[..., 0]
+
+
+def get_suppressed_magnitude(frequencies, X, Fs, tolerance_hz,
+                             normalise=False, band_min=0, band_max=None):
+    tones = get_tone_magnitudes(frequencies, X, Fs, tolerance_hz, normalise,
+                                band_min, band_max)
+    return tones.suppressed_magnitude, tones.suppressed_frequency
 
 
 def db(a, b):
     return 20 * np.log10(float(a)/b)
 
 
+class SparseFilter(object):
+    """ An FIR impulse response stored as its non-zero taps.
+
+    The echo and reverb responses used for AEC testing are a handful of
+    taps spread over thousands of samples, so applying them tap by tap is
+    far cheaper than a dense convolution. apply() switches to FFT
+    convolution when the taps are dense enough for that to be faster.
+
+    Converts to the equivalent dense array wherever numpy expects one, so
+    np.convolve(x, h), np.asarray(h) and arithmetic such as h * window or
+    h + x still work and give arrays. Only scaling by a scalar returns a
+    SparseFilter. """
+
+    def __init__(self, delays, gains, length=None):
+        delays = np.asarray(delays, dtype=np.int64)
+        gains = np.asarray(gains, dtype=np.float64)
+        assert delays.shape == gains.shape and delays.ndim == 1, \
+            "Error: delays and gains must be 1D and the same length"
+        if length is None:
+            length = int(delays.max()) + 1 if len(delays) else 0
+        assert len(delays) == 0 or (delays.min() >= 0 and delays.max() < length), \
+            "Error: tap delays outside of the filter length"
+
+        # Sort and sum any repeated delays so each tap appears once
+        delays, inverse = np.unique(delays, return_inverse=True)
+        self.gains = np.bincount(inverse, weights=gains, minlength=len(delays))
+        self.delays = delays
+        self.length = int(length)
+
+    @classmethod
+    def from_dense(cls, h):
+        """ Makes a SparseFilter from the non-zero taps of a 1D array """
+        h = np.asarray(h, dtype=np.float64)
+        delays = np.flatnonzero(h)
+        return cls(delays, h[delays], len(h))
+
+    def to_dense(self, dtype=np.float64):
+        h = np.zeros(self.length, dtype=dtype)
+        h[self.delays] = self.gains
+        return h
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(np.float64 if dtype is None else dtype)
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def shape(self):
+        return (self.length, )
+
+    def __getitem__(self, index):
+        return self.to_dense()[index]
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # Scaling by a scalar keeps the filter sparse; anything else is done
+        # on the dense array
+        if method == '__call__' and not kwargs and len(inputs) == 2:
+            a, b = inputs
+            if ufunc is np.multiply and np.ndim(b if a is self else a) == 0:
+                return SparseFilter(self.delays, self.gains * (b if a is self else a), self.length)
+            if ufunc is np.true_divide and a is self and np.ndim(b) == 0:
+                return SparseFilter(self.delays, self.gains / b, self.length)
+        inputs = [x.to_dense() if isinstance(x, SparseFilter) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __mul__(self, other):
+        return np.multiply(self, other)
+
+    def __rmul__(self, other):
+        return np.multiply(other, self)
+
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __add__(self, other):
+        return np.add(self, other)
+
+    def __radd__(self, other):
+        return np.add(other, self)
+
+    def __sub__(self, other):
+        return np.subtract(self, other)
+
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+
+    def __neg__(self):
+        return np.negative(self)
+
+    @property
+    def density(self):
+        """ Fraction of the taps which are non-zero """
+        return len(self.delays) / float(max(self.length, 1))
+
+    def apply(self, x, full=True):
+        """ Convolves the last axis of x with the filter.
+
+        With full=True the output has len(x) + len(h) - 1 samples, the same
+        as np.convolve. Otherwise it is truncated to the length of x, which
+        is the echo of x as it would be recorded alongside it. """
+        x = np.asarray(x)
+        sample_count = x.shape[-1]
+        out_length = sample_count + self.length - 1 if full else sample_count
+        dtype = np.result_type(x.dtype, self.gains.dtype)
+
+        if self.density > SPARSE_FILTER_MAX_DENSITY and len(self.delays) > 1:
+            import scipy.signal
+            h = np.reshape(self.to_dense(dtype), (1, ) * (x.ndim - 1) + (-1, ))
+            y = scipy.signal.fftconvolve(x, h, axes=-1)
+            return y[..., :out_length]
+
+        y = np.zeros(x.shape[:-1] + (out_length, ), dtype=dtype)
+        for delay, gain in zip(self.delays, self.gains):
+            tap_length = min(sample_count, out_length - delay)
+            if tap_length > 0:
+                y[..., delay:delay + tap_length] += gain * x[..., :tap_length]
+        return y
+
+
 def reverb_filter(duration_ms, amplitude, delay_ms,
                          sample_rate=DEFAULT_SAMPLE_RATE):
     """ Generates the impulse response for a reverberation.
     The amplitude parameter should be < 1. Larger amplitude = longer reverb.
-    Duration is in milliseconds."""
+    Duration is in milliseconds.
+
+    Returns a SparseFilter with a tap every delay_ms, each amplitude times
+    the one before."""
     delay = int(sample_rate * delay_ms / 1000)
-    signal = np.zeros((int(sample_rate * duration_ms / 1000), ))
-    signal[SYSTEM_DELAY_SAMPLES] = 1
-    for i in range(SYSTEM_DELAY_SAMPLES, int(sample_rate*duration_ms / 1000), delay):
-        delay_i = i + delay
-        if delay_i >= (sample_rate * duration_ms / 1000):
-            break
-        signal[delay_i] = signal[i] * amplitude
-    return signal
+    length = int(sample_rate * duration_ms / 1000)
+    delays = np.arange(SYSTEM_DELAY_SAMPLES, length, delay)
+    # Repeated multiplication rather than a power keeps the taps identical
+    # to the original recursive construction
+    gains = np.cumprod(np.full(len(delays), float(amplitude)))
+    gains = np.concatenate(([1.0], gains[:-1]))
+    return SparseFilter(delays, gains, length)
 
 
 def get_rt60(duration_ms, delay_ms=12, sample_rate=DEFAULT_SAMPLE_RATE):
@@ -87,41 +279,110 @@ def get_rt60(duration_ms, delay_ms=12, sample_rate=DEFAULT_SAMPLE_RATE):
 def echo_filter(duration_ms, amplitude, delay_ms,
                 system_delay_samples=SYSTEM_DELAY_SAMPLES,
                 sample_rate=DEFAULT_SAMPLE_RATE):
-    """ Generates an echo impulse response.
+    """ Generates an echo impulse response, returned as a SparseFilter.
     Duration is in milliseconds."""
     echo_delay_samples = int(sample_rate * delay_ms / 1000)
-    signal = np.zeros((int(sample_rate * duration_ms / 1000), ))
+    length = int(sample_rate * duration_ms / 1000)
     assert(system_delay_samples+echo_delay_samples < int(duration_ms*sample_rate / 1000))
-    signal[system_delay_samples] = 1
-    signal[system_delay_samples + echo_delay_samples] = amplitude
-    return signal
+    return SparseFilter([system_delay_samples, system_delay_samples + echo_delay_samples],
+                        [1, amplitude], length)
+
+
+def _default_noise_seed(samples, db, sample_rate):
+    # Seed using inputs
+    unique_hash = '0x' + hashlib.md5(str(samples + db + sample_rate).encode('utf-8')).hexdigest()[-16:]
+    return int(unique_hash, 16) % 2**32
+
+
+def get_noise_block(seed, block_index, channel=0, out=None):
+    """ Returns one NOISE_BLOCK_SAMPLES block of unit variance white noise.
+
+    Every (channel, block_index) pair has its own numpy.random.Generator
+    stream spawned from SeedSequence(seed), so any block can be made on its
+    own, in any order, thread or process, and is always the same. Writes
+    into out, a contiguous float64 array of at most NOISE_BLOCK_SAMPLES,
+    if given; a shorter out takes the start of the block. """
+    seed_sequence = np.random.SeedSequence(seed, spawn_key=(channel, block_index))
+    generator = np.random.Generator(np.random.PCG64(seed_sequence))
+    if out is None:
+        return generator.standard_normal(NOISE_BLOCK_SAMPLES)
+    generator.standard_normal(len(out), out=out)
+    return out
+
+
+def iter_noise_blocks(duration=None, samples=None, db=0, channels=None,
+                      sample_rate=DEFAULT_SAMPLE_RATE, seed=None):
+    """ Yields NOISE_BLOCK_SAMPLES blocks of the noise made by get_noise.
+    Never ends if neither duration nor samples is given, in which case a
+    seed must be. """
+    if duration:
+        samples = int(duration*sample_rate)
+    if seed is None:
+        assert samples is not None, "Error: endless noise needs a seed"
+        seed = _default_noise_seed(samples, db, sample_rate)
+    factor = np.power(10, db / 20.0)
+    channel_count = 1 if channels is None else channels
+
+    block_index = 0
+    while samples is None or block_index * NOISE_BLOCK_SAMPLES < samples:
+        block_length = NOISE_BLOCK_SAMPLES
+        if samples is not None:
+            block_length = min(block_length, samples - block_index * NOISE_BLOCK_SAMPLES)
+        block = np.empty((channel_count, block_length))
+        for channel in range(channel_count):
+            get_noise_block(seed, block_index, channel, block[channel])
+        block *= factor
+        yield block[0] if channels is None else block
+        block_index += 1
 
 
 def get_noise(duration=None, samples=None, db=0,
-              sample_rate=DEFAULT_SAMPLE_RATE, seed=None):
+              sample_rate=DEFAULT_SAMPLE_RATE, seed=None, channels=None,
+              workers=None):
     """ Generates white noise, useful for generating background noise.
     Set dB to a large negative value (e.g. -150) to generate background
     noise.
-    Either specify a duration in seconds, or number of samples."""
+    Either specify a duration in seconds, or number of samples.
+
+    Returns a 1D array, or a (channels, samples) array if channels is
+    given. The noise only depends on the seed, which defaults to one
+    derived from the parameters, and is made block by block from
+    independent random streams (see get_noise_block) across a pool of
+    workers threads. """
     if duration:
         samples = int(duration*sample_rate)
     if seed is None:
-        # Seed using inputs
-        #seed = (hash(str(samples)) + hash(str(db)) + hash(str(sample_rate))) % 2**32
-        unique_hash = '0x' + hashlib.md5(str(samples + db + sample_rate).encode('utf-8')).hexdigest()[-16:]
-        seed = int(unique_hash, 16) % 2**32
+        seed = _default_noise_seed(samples, db, sample_rate)
 
-    np.random.seed(seed)
-    x = np.random.normal(size=(samples,))
-    factor = np.power(10, db / 20.0)
-    y = x * factor
-    return y
+    channel_count = 1 if channels is None else channels
+    y = np.empty((channel_count, samples))
+    jobs = [(channel, block_index)
+            for channel in range(channel_count)
+            for block_index in range(int(np.ceil(samples / NOISE_BLOCK_SAMPLES)))]
+
+    def make_block(job):
+        channel, block_index = job
+        block_start = block_index * NOISE_BLOCK_SAMPLES
+        get_noise_block(seed, block_index, channel,
+                        y[channel, block_start:block_start + NOISE_BLOCK_SAMPLES])
+
+    if len(jobs) > 1 and workers != 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(make_block, jobs))
+    else:
+        for job in jobs:
+            make_block(job)
+
+    y *= np.power(10, db / 20.0)
+    return y[0] if channels is None else y
 
 
 def get_band_limited_noise(min_freq, max_freq, duration=None, samples=None,
                            sample_rate=16000.0, db=0):
     """ Generates white noise band-limited between the min/max frequencies.
-    The noise is normally distributed in the time domain."""
+    The noise is normally distributed in the time domain.
+    The whole signal is made in memory and normalised to its peak; see
+    iter_band_limited_noise_blocks for long signals."""
     if duration:
         samples = int(duration * sample_rate)
     # Generate random phase
@@ -129,10 +390,8 @@ def get_band_limited_noise(min_freq, max_freq, duration=None, samples=None,
     min_i = int(samples * min_freq / sample_rate)
     # Generate band-limited noise
     noise = np.array([])
-    if duration:
-        noise = get_noise(duration=duration)
-    elif samples:
-        noise = get_noise(samples=samples)
+    if samples:
+        noise = get_noise(samples=samples, sample_rate=sample_rate)
     else:
         print("Error: must provide duration or samples")
         return noise
@@ -147,8 +406,67 @@ def get_band_limited_noise(min_freq, max_freq, duration=None, samples=None,
     return attenuated_noise
 
 
+def band_pass_filter(min_freq, max_freq, sample_rate=DEFAULT_SAMPLE_RATE,
+                     tap_count=BAND_PASS_TAP_COUNT):
+    """ Returns a linear phase windowed-sinc band-pass FIR with tap_count
+    taps. A min_freq of 0 gives a low-pass and a max_freq at or above
+    Nyquist a high-pass filter. """
+    n = np.arange(tap_count) - (tap_count - 1) / 2.0
+
+    def low_pass(cutoff):
+        if cutoff >= sample_rate / 2.0:
+            return (n == 0).astype(np.float64)
+        return 2.0 * cutoff / sample_rate * np.sinc(2.0 * cutoff / sample_rate * n)
+
+    return (low_pass(max_freq) - low_pass(min_freq)) * np.blackman(tap_count)
+
+
+def iter_band_limited_noise_blocks(min_freq, max_freq, duration=None, samples=None,
+                                   sample_rate=16000.0, db=0, seed=None,
+                                   block_length=WRITE_BLOCK_SAMPLES,
+                                   tap_count=BAND_PASS_TAP_COUNT):
+    """ Yields blocks of white noise band-limited between the min/max
+    frequencies, without holding the whole signal.
+
+    The noise from iter_noise_blocks is filtered by band_pass_filter using
+    FFT overlap-add. The gain is set from the filter's energy so the output
+    RMS is full scale / BAND_LIMITED_NOISE_CREST_FACTOR before the db
+    attenuation, rather than normalising by the peak of the whole signal
+    as get_band_limited_noise does. Never ends if neither duration nor
+    samples is given, in which case a seed must be. """
+    if duration:
+        samples = int(duration * sample_rate)
+    if seed is None:
+        assert samples is not None, "Error: endless noise needs a seed"
+        seed = _default_noise_seed(samples, db, sample_rate)
+    h = band_pass_filter(min_freq, max_freq, sample_rate, tap_count)
+    h = h / (BAND_LIMITED_NOISE_CREST_FACTOR * np.sqrt(np.sum(h**2)))
+    fft_length = 1 << int(np.ceil(np.log2(NOISE_BLOCK_SAMPLES + tap_count - 1)))
+    H = np.fft.rfft(h, fft_length)
+    factor = np.power(10, db / 20.0)
+
+    # The first tap_count - 1 outputs are the filter warming up, so that
+    # much extra noise is made and they are dropped
+    warm_up = tap_count - 1
+    noise_samples = None if samples is None else samples + warm_up
+
+    def filtered_blocks():
+        tail = np.zeros(tap_count - 1)
+        skip = warm_up
+        for noise in iter_noise_blocks(samples=noise_samples, seed=seed):
+            y = np.fft.irfft(np.fft.rfft(noise, fft_length) * H, fft_length)[:len(noise) + tap_count - 1]
+            y[:tap_count - 1] += tail
+            tail = y[len(noise):]
+            y = y[skip:len(noise)]
+            skip = max(skip - len(noise), 0)
+            if len(y):
+                yield np.clip(y, -1, 1) * factor
+
+    return rechunk_blocks(filtered_blocks(), block_length)
+
+
 def get_h(h_type='short', normalise=True):
-    """ Generates a transfer function """
+    """ Generates a transfer function, returned as a SparseFilter """
     if h_type == 'short':
         h = echo_filter(200, 0.7, 40)
     elif h_type == 'long':
@@ -160,41 +478,77 @@ def get_h(h_type='short', normalise=True):
     elif h_type == 'delayed':
         h = echo_filter(250, 0.7, 50, system_delay_samples=40+140*16)
     elif h_type == 'random':
-        h = np.random.normal(size=(200,))
+        h = SparseFilter.from_dense(np.random.normal(size=(200,)))
     else:
-        raise Exception("h_type invalid")
+        raise Exception("H type '%s' not valid" % h_type)
 
     if normalise:
-        h = h / np.sum(np.abs(h))
+        h = h / np.sum(np.abs(h.gains))
     return h
-    raise Exception("H type '%s' not valid" % h_type)
 
 
-def get_sine(duration, frequencies, amplitudes=None, phases=None,
-        sample_rate=DEFAULT_SAMPLE_RATE, rshift=0):
-    """ Generates a signal containing one or more sine waves of constant
-    frequency.
-    Duration is in seconds.
-    Frequencies, amplitudes and phases are lists of values. """
+def _cycles(sample_indexes, frequencies, sample_rate):
+    """ Returns the fractional part of the cycles completed by each
+    frequency (Hz) at each sample index, as a (frequencies, samples) array.
+    Wrapping in integer sample counts keeps the phase exact however long
+    the signal is. """
+    frequencies = np.reshape(np.asarray(frequencies, dtype=np.float64), (-1, 1))
+    return np.mod(frequencies * sample_indexes, sample_rate) / sample_rate
 
-    # Do some checks on the input parameters
-    assert (type(frequencies) == list), "Error: frequencies not given as a list"
+
+def _iter_sample_indexes(duration, sample_rate, block_length):
+    """ Yields int64 sample index arrays of each block of a signal duration
+    seconds long, or forever if duration is None """
+    sample_count = None if duration is None else int(duration * sample_rate)
+    block_start = 0
+    while sample_count is None or block_start < sample_count:
+        block_end = block_start + block_length
+        if sample_count is not None:
+            block_end = min(block_end, sample_count)
+        yield np.arange(block_start, block_end, dtype=np.int64)
+        block_start = block_end
+
+
+def _join_blocks(blocks):
+    blocks = list(blocks)
+    return np.concatenate(blocks, axis=-1) if blocks else np.zeros(0)
+
+
+def iter_sine_blocks(frequencies, amplitudes=None, phases=None, duration=None,
+                     sample_rate=DEFAULT_SAMPLE_RATE, rshift=0,
+                     block_length=WRITE_BLOCK_SAMPLES):
+    """ Yields blocks of a signal containing one or more sine waves of
+    constant frequency, continuous in phase across blocks.
+    Duration is in seconds; if None the blocks never end.
+    Frequencies, amplitudes and phases are sequences of values. Every tone
+    in a block is made with one outer product of frequencies and sample
+    indexes, and summed with one dot product. """
     assert (len(frequencies) != 0), "Error: empty list of frequencies"
-    # Set default values for optional parameters
-    if not amplitudes:
+    if amplitudes is None or len(amplitudes) == 0:
         amplitudes = np.ones(len(frequencies))
-    if not phases:
+    if phases is None or len(phases) == 0:
         phases = np.zeros(len(frequencies))
     assert (len(frequencies) == len(phases)), \
             "Error: Frequencies and phases have different size"
     assert (len(frequencies) == len(amplitudes)), \
-            "Error: Frequencies and phases have different size"
+            "Error: Frequencies and amplitudes have different size"
+    amplitudes = np.asarray(amplitudes, dtype=np.float64) / (1<<rshift)
+    phases = np.reshape(np.asarray(phases, dtype=np.float64), (-1, 1))
 
-    x = np.linspace(0, duration * 2 * np.pi, int(duration * sample_rate))
-    signal = np.zeros((int(duration * sample_rate),))
-    for idx in range(len(frequencies)):
-        signal += amplitudes[idx] * np.sin(frequencies[idx] * x + phases[idx])
-    return signal / (1<<rshift)
+    for sample_indexes in _iter_sample_indexes(duration, sample_rate, block_length):
+        tones = np.sin(2 * np.pi * _cycles(sample_indexes, frequencies, sample_rate) + phases)
+        yield np.dot(amplitudes, tones)
+
+
+def get_sine(duration, frequencies, amplitudes=None, phases=None,
+        sample_rate=DEFAULT_SAMPLE_RATE, rshift=0):
+    """ Generates a signal containing one or more sine waves of constant
+    frequency.
+    Duration is in seconds.
+    Frequencies, amplitudes and phases are lists of values. """
+    assert (type(frequencies) == list), "Error: frequencies not given as a list"
+    return _join_blocks(iter_sine_blocks(frequencies, amplitudes, phases, duration,
+                                         sample_rate, rshift))
 
 
 def get_near_end(duration, frequencies=[700], sample_rate=DEFAULT_SAMPLE_RATE,
@@ -205,6 +559,18 @@ def get_near_end(duration, frequencies=[700], sample_rate=DEFAULT_SAMPLE_RATE,
                     rshift=rshift)
 
 
+def iter_ref_discrete_blocks(duration, freq_a=1000, freq_b=2000, period=1,
+                             sample_rate=DEFAULT_SAMPLE_RATE, rshift=0,
+                             block_length=WRITE_BLOCK_SAMPLES):
+    """ Yields blocks of the signal made by get_ref_discrete.
+    Duration is in seconds; if None the blocks never end."""
+    for sample_indexes in _iter_sample_indexes(duration, sample_rate, block_length):
+        cycles = _cycles(sample_indexes, [freq_a, freq_b, 0.5 / period], sample_rate)
+        y_1, y_2, envelope = np.sin(2 * np.pi * cycles)
+        envelope = envelope**2
+        yield (envelope * y_1 + (1 - envelope) * y_2) / (1<<rshift)
+
+
 def get_ref_discrete(duration, freq_a=1000, freq_b=2000, period=1,
                      sample_rate=DEFAULT_SAMPLE_RATE, rshift=0):
     """ Gets a reference signal which oscillates between two frequencies
@@ -212,11 +578,23 @@ def get_ref_discrete(duration, freq_a=1000, freq_b=2000, period=1,
     The signal produced will have magnitude in the frequency domain at only
     those two frequencies.
     Duration is in seconds."""
-    x = np.linspace(0, duration * 2 * np.pi, duration * sample_rate)
-    y_1 = np.sin(freq_a * x)
-    y_2 = np.sin(freq_b * x)
-    signal = np.sin(x / (period*2))**2 * y_1 + np.cos(x / (period*2))**2 * y_2
-    return signal / (1<<rshift)
+    return _join_blocks(iter_ref_discrete_blocks(duration, freq_a, freq_b, period,
+                                                 sample_rate, rshift))
+
+
+def iter_ref_continuous_blocks(duration, freq_a=500, freq_b=4000, period=0.2,
+                               sample_rate=DEFAULT_SAMPLE_RATE, rshift=0,
+                               block_length=WRITE_BLOCK_SAMPLES):
+    """ Yields blocks of the signal made by get_ref_continuous.
+    Duration is in seconds; if None the blocks never end."""
+    # Phase in cycles at the end of the previous block, wrapped to [0, 1)
+    phase = 0.0
+    for sample_indexes in _iter_sample_indexes(duration, sample_rate, block_length):
+        modulation = np.sin(2 * np.pi * _cycles(sample_indexes, [1.0 / period], sample_rate)[0])
+        f = (modulation*(freq_b-freq_a) / 2) + ((freq_a+freq_b)/2)
+        cycles = phase + np.cumsum(f) / sample_rate
+        phase = np.mod(cycles[-1], 1.0)
+        yield np.sin(2 * np.pi * cycles) / (1<<rshift)
 
 
 def get_ref_continuous(duration, freq_a=500, freq_b=4000, period=0.2,
@@ -228,12 +606,8 @@ def get_ref_continuous(duration, freq_a=500, freq_b=4000, period=0.2,
     frequencies between the two frequencies.
     Duration is in seconds."""
     # Using a cumulative sum to avoid phase error when changing frequency
-    x = np.linspace(0, duration * 2 * np.pi, duration * sample_rate)
-    f = (np.sin(x / period)*(freq_b-freq_a) / 2) + ((freq_a+freq_b)/2)
-    y = np.cumsum(f) / sample_rate * 2 * np.pi
-    z = np.sin(y)
-    signal = z
-    return signal / (1<<rshift)
+    return _join_blocks(iter_ref_continuous_blocks(duration, freq_a, freq_b, period,
+                                                   sample_rate, rshift))
 
 
 def get_ref(duration, ref='continuous', sample_rate=DEFAULT_SAMPLE_RATE):
@@ -248,12 +622,35 @@ def get_ref(duration, ref='continuous', sample_rate=DEFAULT_SAMPLE_RATE):
     elif ref == "noise":
         return get_noise(duration, sample_rate=sample_rate, db=0)
     elif ref == "bandlimited":
-        return get_band_limited_noise(1000, 4000, duration,
-                                      sample_rate=sample_rate)
+        return _join_blocks(iter_band_limited_noise_blocks(1000, 4000, duration,
+                                                           sample_rate=sample_rate))
     else:
         raise Exception("ref name \"{}\" invalid.".format(ref))
 
 
+def iter_ref_blocks(duration, ref='continuous', sample_rate=DEFAULT_SAMPLE_RATE,
+                    block_length=WRITE_BLOCK_SAMPLES):
+    """ Yields blocks of the reference signal made by get_ref.
+    Duration is in seconds."""
+    if ref == "continuous":
+        return iter_ref_continuous_blocks(duration, sample_rate=sample_rate,
+                                          block_length=block_length)
+    elif ref == "discrete":
+        return iter_ref_discrete_blocks(duration, sample_rate=sample_rate,
+                                        block_length=block_length)
+    elif ref == "single":
+        return iter_sine_blocks([1000], duration=duration, sample_rate=sample_rate,
+                                block_length=block_length)
+    elif ref == "noise":
+        return rechunk_blocks(iter_noise_blocks(duration, sample_rate=sample_rate, db=0),
+                              block_length)
+    elif ref == "bandlimited":
+        return iter_band_limited_noise_blocks(1000, 4000, duration, sample_rate=sample_rate,
+                                              block_length=block_length)
+    else:
+        return iter_blocks(get_ref(duration, ref, sample_rate), block_length)
+
+
 def get_headroom_divisor(data, headroom):
     """ Get the divisor that gives a number of bits of headroom.
 
@@ -264,12 +661,73 @@ def get_headroom_divisor(data, headroom):
     return divisor
 
 
+def iter_blocks(data, block_length=WRITE_BLOCK_SAMPLES):
+    """ Splits a (channels, samples) or 1D array into blocks of at most
+    block_length samples, without copying. """
+    for block_start in range(0, np.shape(data)[-1], block_length):
+        yield data[..., block_start:block_start + block_length]
+
+
+def rechunk_blocks(blocks, block_length):
+    """ Regroups an iterable of blocks of any lengths into blocks of exactly
+    block_length samples, apart from the last which may be shorter. An
+    array is split with iter_blocks. """
+    if isinstance(blocks, np.ndarray):
+        for block in iter_blocks(blocks, block_length):
+            yield block
+        return
+
+    pending = []
+    pending_length = 0
+    for block in blocks:
+        block = np.asarray(block)
+        pending.append(block)
+        pending_length += block.shape[-1]
+        if pending_length < block_length:
+            continue
+        joined = np.concatenate(pending, axis=-1)
+        whole_length = (pending_length // block_length) * block_length
+        for block_start in range(0, whole_length, block_length):
+            yield joined[..., block_start:block_start + block_length]
+        pending = [joined[..., whole_length:]]
+        pending_length -= whole_length
+    if pending_length:
+        yield np.concatenate(pending, axis=-1)
+
+
+def _to_integer_samples(block, dtype, rshift=0):
+    # Saturate rather than wrap samples outside [-1, 1]
+    block = np.clip(block, -1, 1)
+    return np.asarray(block*np.iinfo(dtype).max, dtype=dtype) >> rshift
+
+
 def write_data(data, filename, sample_rate=DEFAULT_SAMPLE_RATE, dtype=np.int32,
                rshift=0):
     """ Writes array data in the range [-1, 1] to a wav file of arbitrary
-    data type."""
-    output = np.asarray(data*np.iinfo(dtype).max, dtype=dtype) >> rshift
-    scipy.io.wavfile.write(filename, sample_rate, output.T)
+    data type.
+
+    data is either a (channels, samples) or 1D array, or an iterable of such
+    blocks, e.g. a generator. The data is scaled and written one block at a
+    time so only a block's worth of integer samples exists at once."""
+    # Used for the header if no blocks arrive, so empty data still writes a file
+    channel_count = 1
+    if isinstance(data, np.ndarray):
+        channel_count = 1 if data.ndim == 1 else data.shape[0]
+        data = iter_blocks(data)
+
+    writer = None
+    try:
+        for block in data:
+            output = _to_integer_samples(block, dtype, rshift)
+            if writer is None:
+                channel_count = 1 if output.ndim == 1 else output.shape[0]
+                writer = audio_wav_utils.WavWriter(filename, sample_rate, channel_count, dtype)
+            writer.write(output.T)
+        if writer is None:
+            writer = audio_wav_utils.WavWriter(filename, sample_rate, channel_count, dtype)
+    finally:
+        if writer is not None:
+            writer.close()
 
 
 def get_filenames(testname, echo_type, ref_type, headroom):
@@ -292,11 +750,433 @@ def write_audio(test_class, echo_type, ref_type, headroom, AudioIn, AudioRef,
         pass
     if adjust_headroom:
         divisor = get_headroom_divisor(AudioIn, headroom)
-        AudioIn = AudioIn / divisor
-        AudioRef = AudioRef / divisor
+        AudioIn = (block / divisor for block in iter_blocks(AudioIn))
+        AudioRef = (block / divisor for block in iter_blocks(AudioRef))
     in_filename, ref_filename, _ = get_filenames(test_class, echo_type,
                                                  ref_type, headroom)
     write_data(AudioIn, os.path.join(audio_dir, in_filename + ".wav"),
                sample_rate, dtype)
     write_data(AudioRef, os.path.join(audio_dir, ref_filename + ".wav"),
                sample_rate, dtype)
+
+
+class PartitionedConvolver(object):
+    """ Streaming convolution with a fixed impulse response.
+
+    Uses uniformly partitioned overlap-save FFT convolution: h is split into
+    partitions of block_length taps and each input block is transformed
+    once, then multiplied with every partition's spectrum from a delay line
+    of past input spectra. Partitions which are all zero, as in most of a
+    sparse echo response, are skipped.
+
+    process() takes blocks of block_length samples along the last axis and
+    returns the matching block of x convolved with h. The input spectra do
+    not depend on h, so push() and output() can be used to convolve each
+    block with several responses of up to max_length taps. """
+
+    def __init__(self, h, block_length=ECHO_BLOCK_SAMPLES, max_length=0):
+        self.block_length = block_length
+        self.partition_count = max(int(np.ceil(max(len(h), max_length) / block_length)), 1)
+        self.partition_indexes, self.partition_spectra = self.partition(h)
+        self.input_spectra = None
+        self.previous_block = None
+        self.position = 0
+        self.sample_count = 0
+
+    def partition(self, h):
+        """ Returns the indexes and spectra of the non-zero partitions of h """
+        h = np.asarray(h, dtype=np.float64)
+        assert len(h) <= self.partition_count * self.block_length, "Error: h longer than max_length"
+        h = np.pad(h, (0, self.partition_count * self.block_length - len(h)), 'constant')
+        partitions = np.reshape(h, (self.partition_count, self.block_length))
+        partition_indexes = np.flatnonzero(np.any(partitions != 0, axis=1))
+        return partition_indexes, np.fft.rfft(partitions[partition_indexes], 2 * self.block_length)
+
+    def process(self, block):
+        self.push(block)
+        return self.output(self.partition_indexes, self.partition_spectra)
+
+    def push(self, block):
+        """ Adds the next input block to the delay line """
+        block = np.asarray(block, dtype=np.float64)
+        sample_count = block.shape[-1]
+        assert sample_count <= self.block_length, "Error: block longer than block_length"
+        if sample_count < self.block_length:
+            padding = [(0, 0)] * (block.ndim - 1) + [(0, self.block_length - sample_count)]
+            block = np.pad(block, padding, 'constant')
+
+        if self.input_spectra is None:
+            self.previous_block = np.zeros_like(block)
+            self.input_spectra = np.zeros((self.partition_count, ) + block.shape[:-1] + (self.block_length + 1, ),
+                                          dtype=np.complex128)
+
+        # The delay line is a ring; the spectrum from k blocks ago is at
+        # (position + k) % partition_count
+        self.position = (self.position - 1) % self.partition_count
+        self.input_spectra[self.position] = np.fft.rfft(np.concatenate((self.previous_block, block), axis=-1))
+        self.previous_block = block
+        self.sample_count = sample_count
+
+    def output(self, partition_indexes, partition_spectra):
+        """ Returns the last block pushed convolved with the partitioned
+        response returned by partition() """
+        delayed = self.input_spectra[(self.position + partition_indexes) % self.partition_count]
+        spectra = np.reshape(partition_spectra, (len(partition_indexes), ) + (1, ) * (delayed.ndim - 2) + (-1, ))
+        Y = np.sum(delayed * spectra, axis=0)
+        y = np.fft.irfft(Y, 2 * self.block_length)[..., self.block_length:]
+        return y[..., :self.sample_count]
+
+
+class TimeVaryingConvolver(object):
+    """ Streaming convolution with an echo path that changes over time.
+
+    schedule is a list of (switch_time, h) pairs, with switch_time in
+    seconds and h a get_h type name, an array or a SparseFilter. The first
+    path applies from the start of the signal whatever its switch time.
+    Each change crossfades linearly from the old path's output to the new
+    one over crossfade_ms, starting at the switch time.
+
+    All paths share one PartitionedConvolver delay line, so each block is
+    transformed once and only the paths audible in that block, found by
+    binary search of the schedule, are applied. A path change costs one
+    transform of the new response, which is freed once it has faded out. Has the same
+    process() interface as PartitionedConvolver. """
+
+    def __init__(self, schedule, crossfade_ms=20, sample_rate=DEFAULT_SAMPLE_RATE,
+                 block_length=ECHO_BLOCK_SAMPLES):
+        assert len(schedule) != 0, "Error: empty echo path schedule"
+        schedule = sorted(schedule, key=lambda path: path[0])
+        paths = [get_h(h) if isinstance(h, str) else h for _, h in schedule]
+        self.switch_samples = np.array([int(switch_time * sample_rate) for switch_time, _ in schedule])
+        self.crossfade_samples = int(crossfade_ms * sample_rate / 1000)
+
+        max_length = max(len(h) for h in paths)
+        self.convolver = PartitionedConvolver(paths[0], block_length, max_length)
+        self.partitions = [None] * len(paths)
+        self.partitions[0] = (self.convolver.partition_indexes, self.convolver.partition_spectra)
+        self.paths = paths
+        self.block_start = 0
+        self.first_path = 0
+        # The sample from which each path is silent for good
+        self.path_ends = np.append(self.switch_samples[1:] + max(self.crossfade_samples - 1, 0),
+                                   np.iinfo(np.int64).max)
+
+    def get_path_gains(self, sample_indexes):
+        """ Returns the indexes of the paths audible at any of the sorted
+        sample_indexes and their (paths, samples) crossfade gains. Only the
+        paths whose crossfades overlap the samples are looked at. """
+        # Path k fades in from its switch sample and is gone once path k + 1
+        # has fully faded in
+        first = np.searchsorted(self.path_ends, sample_indexes[0], side='right')
+        last = max(np.searchsorted(self.switch_samples, sample_indexes[-1], side='right') - 1, 0)
+        path_indexes = np.arange(first, last + 1)
+
+        # The fade in ramp of each path and of the path after the last
+        ramp_indexes = np.arange(first, min(last + 2, len(self.switch_samples)))
+        ramps = sample_indexes[np.newaxis, :] - self.switch_samples[ramp_indexes, np.newaxis]
+        if self.crossfade_samples:
+            ramps = np.clip((ramps + 1) / float(self.crossfade_samples), 0, 1)
+        else:
+            ramps = (ramps >= 0).astype(np.float64)
+        ramps[ramp_indexes == 0] = 1
+        if len(ramp_indexes) == len(path_indexes):
+            ramps = np.concatenate((ramps, np.zeros((1, len(sample_indexes)))))
+        return path_indexes, ramps[:-1] - ramps[1:]
+
+    def process(self, block):
+        self.convolver.push(block)
+        sample_count = self.convolver.sample_count
+        path_indexes, gains = self.get_path_gains(self.block_start + np.arange(sample_count))
+        self.block_start += sample_count
+
+        # Paths before the first audible one have faded out for good
+        for path_index in range(self.first_path, path_indexes[0] if len(path_indexes) else self.first_path):
+            self.partitions[path_index] = None
+            self.paths[path_index] = None
+        self.first_path = max(self.first_path, path_indexes[0] if len(path_indexes) else 0)
+
+        y = 0
+        for path_index, path_gains in zip(path_indexes, gains):
+            if not np.any(path_gains):
+                continue
+            if self.partitions[path_index] is None:
+                self.partitions[path_index] = self.convolver.partition(self.paths[path_index])
+                # The response is kept as its partitions from here on
+                self.paths[path_index] = None
+            y = y + path_gains * self.convolver.output(*self.partitions[path_index])
+        return y
+
+
+def iter_time_varying_echo(ref, schedule, crossfade_ms=20,
+                           sample_rate=DEFAULT_SAMPLE_RATE,
+                           block_length=ECHO_BLOCK_SAMPLES):
+    """ Yields blocks of the echo of ref, an array or iterable of blocks,
+    through the changing echo paths in schedule. See TimeVaryingConvolver
+    for the schedule format. """
+    convolver = TimeVaryingConvolver(schedule, crossfade_ms, sample_rate, block_length)
+    for ref_block in rechunk_blocks(ref, block_length):
+        yield convolver.process(ref_block)
+
+
+def iter_echo_blocks(ref, h, near_end=None, noise_db=None, seed=0,
+                     block_length=ECHO_BLOCK_SAMPLES):
+    """ Streams an echo scenario, yielding (AudioIn, AudioRef) blocks.
+
+    ref and near_end are arrays or iterables of blocks, e.g. generators, and
+    h is an impulse response array or SparseFilter, or a convolver such as
+    TimeVaryingConvolver made with the same block_length. AudioIn is the echo of
+    ref through h, plus near_end and white background noise at noise_db
+    when given. It has the same length as ref, so the tail of the last echo
+    is dropped. Only one block of each signal is held at a time. """
+    convolver = h if hasattr(h, 'process') else PartitionedConvolver(h, block_length)
+    if near_end is not None:
+        near_end = rechunk_blocks(near_end, block_length)
+    noise = None
+
+    for ref_block in rechunk_blocks(ref, block_length):
+        audio_in = convolver.process(ref_block)
+        if near_end is not None:
+            near_end_block = next(near_end, None)
+            if near_end_block is not None:
+                audio_in[..., :near_end_block.shape[-1]] += near_end_block
+        if noise_db is not None:
+            if noise is None:
+                channels = audio_in.shape[0] if audio_in.ndim > 1 else None
+                noise = rechunk_blocks(iter_noise_blocks(db=noise_db, channels=channels, seed=seed),
+                                       block_length)
+            audio_in += next(noise)[..., :audio_in.shape[-1]]
+        yield audio_in, ref_block
+
+
+@functools.lru_cache(maxsize=None)
+def _library_version():
+    """ Returns the release version and a hash of this module's source, so
+    cached stimuli are remade whenever the generators change """
+    version = "unknown"
+    build_info = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, "audio_test_tools", "module_build_info")
+    try:
+        with open(build_info) as f:
+            for line in f:
+                if line.startswith("VERSION"):
+                    version = line.split("=", 1)[1].strip()
+    except (IOError, OSError):
+        pass
+    with open(os.path.abspath(__file__), "rb") as f:
+        return "%s+%s" % (version, hashlib.sha1(f.read()).hexdigest())
+
+
+def _stimulus_json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, SparseFilter):
+        return {"delays": value.delays.tolist(), "gains": value.gains.tolist(), "length": value.length}
+    if isinstance(value, (type, np.dtype)):
+        return np.dtype(value).name
+    raise TypeError("Cannot hash stimulus parameter %r" % (value, ))
+
+
+def get_stimulus_key(generator, params):
+    """ Returns a hash of the generator function, its keyword parameters and
+    the library version """
+    key = json.dumps({"generator": "%s.%s" % (generator.__module__, generator.__name__),
+                      "params": params,
+                      "version": _library_version()},
+                     sort_keys=True, default=_stimulus_json_default)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _place_file(source, destination):
+    """ Atomically puts a copy of source at destination. A copy rather than
+    a hard link, so rewriting the destination cannot change the cache. """
+    directory = os.path.dirname(os.path.abspath(destination))
+    fd, tmp_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp_file)
+        os.replace(tmp_file, destination)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def cache_stimulus(generator, params, filenames, cache_dir=None, max_bytes=None):
+    """ Makes the files in filenames by calling generator(filenames, **params)
+    unless an earlier call with the same generator, params and library
+    version is in the stimulus cache, in which case they are copied from
+    there.
+
+    New files are generated under temporary names and renamed into the
+    cache, so parallel workers never see partial files; at worst two
+    workers both generate the same entry. An entry pruned by another
+    worker while it is being read is generated again. The cache is then pruned to
+    max_bytes, least recently used first. Returns the generator's return
+    value, which is cached alongside the files so must be JSON
+    serialisable. """
+    cache_dir = STIMULUS_CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = STIMULUS_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    key = get_stimulus_key(generator, params)
+    cached_filenames = [os.path.join(cache_dir, "%s-%d.stimulus" % (key, i))
+                        for i in range(len(filenames))]
+    result_filename = os.path.join(cache_dir, "%s-result.stimulus" % key)
+
+    try:
+        for cached in cached_filenames + [result_filename]:
+            # Mark as recently used
+            os.utime(cached)
+        with open(result_filename) as f:
+            result = json.load(f)
+        for cached, filename in zip(cached_filenames, filenames):
+            _place_file(cached, filename)
+        return result
+    except (OSError, ValueError):
+        # Not cached, or pruned by another worker part way through
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_filenames = []
+    try:
+        for _ in range(len(filenames) + 1):
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            os.close(fd)
+            tmp_filenames.append(tmp_file)
+        result = generator(tmp_filenames[1:], **params)
+        with open(tmp_filenames[0], "w") as f:
+            json.dump(result, f)
+        # Place the files from the temporary names, which no other worker
+        # can prune, before moving them into the cache
+        for tmp_file, filename in zip(tmp_filenames[1:], filenames):
+            _place_file(tmp_file, filename)
+        for tmp_file, cached in zip(tmp_filenames, [result_filename] + cached_filenames):
+            os.replace(tmp_file, cached)
+    finally:
+        for tmp_file in tmp_filenames:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    common_utils.prune_cache(cache_dir, max_bytes, "*.stimulus")
+    return result
+
+
+def write_echo_scenario(test_class, echo_type, ref_type, headroom, duration,
+                        near_end_frequencies=None, noise_db=None, seed=0,
+                        sample_rate=DEFAULT_SAMPLE_RATE, audio_dir='spec_audio',
+                        dtype=np.int32, block_length=ECHO_BLOCK_SAMPLES,
+                        cache=False):
+    """ Generates and writes AudioIn/AudioRef wavs for an AEC test without
+    holding the echo or microphone signals in memory.
+
+    echo_type and ref_type are as taken by get_h and get_ref, and the near
+    end is a sine at near_end_frequencies as made by get_near_end. The
+    scenario is generated twice: once to find the peak for the headroom
+    adjustment done by write_audio and once to write the files. If cache is
+    True the files are reused from the stimulus cache when they have been
+    generated before (see cache_stimulus). Returns the AudioIn and AudioRef
+    filenames and the headroom divisor the signals were divided by. """
+    try:
+        os.makedirs(audio_dir)
+    except os.error:
+        pass
+    in_filename, ref_filename, _ = get_filenames(test_class, echo_type,
+                                                 ref_type, headroom)
+    filenames = [os.path.join(audio_dir, in_filename + ".wav"),
+                 os.path.join(audio_dir, ref_filename + ".wav")]
+    params = dict(echo_type=echo_type, ref_type=ref_type, headroom=headroom,
+                  duration=duration, near_end_frequencies=near_end_frequencies,
+                  noise_db=noise_db, seed=seed, sample_rate=sample_rate,
+                  dtype=dtype, block_length=block_length)
+    if cache:
+        divisor = cache_stimulus(_write_echo_scenario_files, params, filenames)
+    else:
+        divisor = _write_echo_scenario_files(filenames, **params)
+    return filenames[0], filenames[1], divisor
+
+
+def _write_echo_scenario_files(filenames, echo_type, ref_type, headroom, duration,
+                               near_end_frequencies, noise_db, seed, sample_rate,
+                               dtype, block_length):
+    h = get_h(echo_type)
+
+    def scenario_blocks():
+        ref = iter_ref_blocks(duration, ref_type, sample_rate, block_length)
+        near_end = None
+        if near_end_frequencies:
+            near_end = iter_sine_blocks(near_end_frequencies, duration=duration, sample_rate=sample_rate,
+                                        rshift=4, block_length=block_length)
+        return iter_echo_blocks(ref, h, near_end, noise_db, seed, block_length)
+
+    peak = max(np.abs(audio_in).max() for audio_in, _ in scenario_blocks())
+    divisor = peak * (1<<headroom)
+
+    in_filename, ref_filename = filenames
+    with audio_wav_utils.WavWriter(in_filename, sample_rate, 1, dtype) as in_writer, \
+         audio_wav_utils.WavWriter(ref_filename, sample_rate, 1, dtype) as ref_writer:
+        for audio_in, audio_ref in scenario_blocks():
+            in_writer.write(_to_integer_samples(audio_in / divisor, dtype))
+            ref_writer.write(_to_integer_samples(audio_ref / divisor, dtype))
+    return float(divisor)
+
+
+def expand_test_matrix(spec):
+    """ Expands a test matrix spec into one write_echo_scenario keyword
+    argument dict per scenario.
+
+    spec is a dict with a test_class and lists of echo_types, ref_types and
+    headrooms, whose every combination is a scenario. Any other entries,
+    e.g. duration, near_end_frequencies, noise_db, seed or sample_rate, are
+    passed to every scenario. """
+    common = dict(spec)
+    grid = [common.pop(name) for name in ("echo_types", "ref_types", "headrooms")]
+    return [dict(common, echo_type=echo_type, ref_type=ref_type, headroom=headroom)
+            for echo_type, ref_type, headroom in itertools.product(*grid)]
+
+
+def _write_matrix_scenario(scenario):
+    in_filename, ref_filename, divisor = write_echo_scenario(**scenario)
+    params = dict(scenario)
+    if "dtype" in params:
+        params["dtype"] = np.dtype(params["dtype"]).name
+    return {"audio_in": in_filename, "audio_ref": ref_filename,
+            "headroom_divisor": divisor, "params": params}
+
+
+def write_test_matrix(spec, audio_dir='spec_audio', manifest_filename=None,
+                      processes=None, cache=False):
+    """ Writes every scenario of a test matrix (see expand_test_matrix) with
+    write_echo_scenario, spread over a pool of processes, one per core by
+    default.
+
+    A JSON manifest listing each scenario's files, parameters and headroom
+    divisor is written to manifest_filename, by default
+    <audio_dir>/<test_class>-manifest.json, and returned. """
+    scenarios = [dict(scenario, audio_dir=audio_dir, cache=cache)
+                 for scenario in expand_test_matrix(spec)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        entries = list(executor.map(_write_matrix_scenario, scenarios))
+
+    spec = json.loads(json.dumps(spec, default=_stimulus_json_default))
+    manifest = {"spec": spec, "library_version": _library_version(), "scenarios": entries}
+    if manifest_filename is None:
+        manifest_filename = os.path.join(audio_dir, spec["test_class"] + "-manifest.json")
+    common_utils.dict_to_json(manifest, manifest_filename)
+    return manifest
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Write the AEC test audio for a test matrix spec")
+    parser.add_argument("spec", help="json test matrix spec, see expand_test_matrix")
+    parser.add_argument("--audio-dir", help="output directory", default="spec_audio")
+    parser.add_argument("--manifest", help="manifest filename, default <audio-dir>/<test_class>-manifest.json")
+    parser.add_argument("--processes", help="worker processes, default one per core", type=int)
+    parser.add_argument("--cache", help="reuse files from the stimulus cache", action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    write_test_matrix(common_utils.json_to_dict(args.spec), args.audio_dir, args.manifest,
+                      args.processes, args.cache)
@@ -8,11 +8,9 @@ from __future__ import division
 from __future__ import print_function
 from builtins import str
 from builtins import range
+import functools
+import itertools
 import numpy as np
-import scipy.io.wavfile
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas
 
 speed_of_sound = 342.0
 
@@ -29,25 +27,64 @@ circular_mic_array = np.asarray(
     )
 
 def distance_between_points(a, b):
-    return np.sqrt(sum((a-b)**2))
+    return np.sqrt(np.sum((np.asarray(a)-np.asarray(b))**2, axis=-1))
+
+# Distance between every pair of points in a (..., points, 3) array, shaped
+# (..., points, points)
+def pairwise_distances(p):
+    p = np.asarray(p)
+    return distance_between_points(p[..., :, np.newaxis, :], p[..., np.newaxis, :, :])
 
 def translate_position(p, x, y, z):
     p_t = p + np.asarray([x, y, z])
     return p_t
 
+# The matrices rotate_around_{x,y,z}_axis apply for each of an array of
+# angles, shaped theta.shape + (3, 3)
+def rotation_matrices(axis, theta):
+    theta = np.asarray(theta, dtype=np.float64)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    one = np.ones_like(theta)
+    zero = np.zeros_like(theta)
+    if axis == 'x':
+        R = [[one, zero, zero], [zero, c, -s], [zero, s, c]]
+    elif axis == 'y':
+        R = [[c, zero, s], [zero, one, zero], [-s, zero, c]]
+    elif axis == 'z':
+        R = [[c, -s, zero], [s, c, zero], [zero, zero, one]]
+    else:
+        raise ValueError("axis must be 'x', 'y' or 'z'")
+    return np.moveaxis(np.asarray(R), (0, 1), (-2, -1))
+
 def rotate_around_x_axis(p, theta):
-    R = np.asarray([[1., 0., 0.],[0., np.cos(theta), -np.sin(theta)],[0., np.sin(theta), np.cos(theta)]])
-    p_t = np.dot(p, R)
+    p_t = transform_positions(p, x_theta=theta)
     return p_t
 
 def rotate_around_y_axis(p, theta):
-    R = np.asarray([[np.cos(theta), 0., np.sin(theta)],[0., 1., 0.],[-np.sin(theta), 0., np.cos(theta)]])
-    p_t = np.dot(p, R)
+    p_t = transform_positions(p, y_theta=theta)
     return p_t
 
 def rotate_around_z_axis(p, theta):
-    R = np.asarray([[np.cos(theta), -np.sin(theta), 0.],[np.sin(theta), np.cos(theta), 0.],[0., 0., 1.,]])
-    p_t = np.dot(p, R)
+    p_t = transform_positions(p, z_theta=theta)
+    return p_t
+
+# Rotate the points p around the x, then y, then z axis and then translate
+# them, for whole arrays of orientations at once. The rotate_around_*_axis
+# functions are single axis cases of this, with the same axis order. The angles broadcast
+# together to a shape S and translation broadcasts to S + (3,). Returns the
+# transformed points shaped S + p.shape. Each rotation matches the
+# corresponding rotate_around_*_axis function.
+def transform_positions(p, x_theta=0.0, y_theta=0.0, z_theta=0.0, translation=None):
+    R = np.matmul(np.matmul(rotation_matrices('x', x_theta), rotation_matrices('y', y_theta)),
+                  rotation_matrices('z', z_theta))
+    p = np.asarray(p, dtype=np.float64)
+    # Leave room for any leading dimensions of p
+    R = np.reshape(R, R.shape[:-2] + (1,) * (p.ndim - 2) + (3, 3))
+    p_t = np.matmul(p, R)
+    if translation is not None:
+        translation = np.asarray(translation, dtype=np.float64)
+        p_t = p_t + np.reshape(translation, translation.shape[:-1] + (1,) * (p.ndim - 1) + (3,))
     return p_t
 
 def print_phi(phi):
@@ -59,18 +96,25 @@ def print_phi(phi):
     print ('')
     return
 
-def make_mvdr_matrices(f_bin_count, fft_length, channel_count, rate):
-    W = np.zeros((f_bin_count, channel_count, channel_count))
-    mu = 0.0000001
-    for f_bin in range(f_bin_count):
-        freq = 2.0*np.pi*float(f_bin) / float(fft_length)  * float(rate)
-        for i in range(channel_count):
-            for j in range(channel_count):
-                v = np.sinc(freq*d(i, j)/speed_of_sound)
-                if i==j:
-                    v += mu
-                W[f_bin][i][j] = v
-        W[f_bin] = np.linalg.pinv(W[f_bin])
+def make_mvdr_matrices(f_bin_count, fft_length, channel_count, rate, mic_array=circular_mic_array, mu=0.0000001):
+    """ Returns the (f_bin_count, channel_count, channel_count) inverses of the
+    diffuse noise coherence matrices of the first channel_count mics of
+    mic_array, regularised by mu.
+
+    Results are cached, so the returned array is read-only. """
+    mic_array = np.asarray(mic_array, dtype=np.float64)[:channel_count]
+    return _make_mvdr_matrices(f_bin_count, fft_length, float(rate), mic_array.tobytes(), channel_count, mu)
+
+@functools.lru_cache(maxsize=32)
+def _make_mvdr_matrices(f_bin_count, fft_length, rate, mic_array_bytes, channel_count, mu):
+    mic_array = np.frombuffer(mic_array_bytes, dtype=np.float64).reshape(channel_count, 3)
+    d = np.sqrt(np.sum((mic_array[:, np.newaxis, :] - mic_array[np.newaxis, :, :])**2, axis=-1))
+    freq = np.arange(f_bin_count) / float(fft_length) * rate
+    # Coherence of a diffuse noise field, sin(w*d/c)/(w*d/c)
+    W = np.sinc(2.0 * freq[:, np.newaxis, np.newaxis] * d[np.newaxis, :, :] / speed_of_sound)
+    W += mu * np.eye(channel_count)
+    W = np.linalg.solve(W, np.broadcast_to(np.eye(channel_count), W.shape))
+    W.flags.writeable = False
     return W
 
 # Apply a sample delay to a frequency domain frame (can be -ve as well)
@@ -79,31 +123,127 @@ def steer_channel(Channel, delay):
     w = np.exp(-2.0j*np.pi*np.arange(len(Channel))/float(fft_length) * float(delay))
     return Channel * w
 
+# Make a table of the phasors steer_channel would apply for each of delays,
+# shaped delays.shape + (bin_count,)
+def make_steering_table(delays, bin_count):
+    delays = np.asarray(delays, dtype=np.float64)
+    fft_length = ((bin_count-1) *2)
+    phase = -2.0j*np.pi*np.arange(bin_count)/float(fft_length)
+    return np.exp(delays[..., np.newaxis] * phase)
+
+# Sample delays that time-align each mic for a plane wave arriving from each
+# of the unit direction vectors, shaped (directions, mics)
+def look_direction_delays(directions, rate, mic_array=circular_mic_array):
+    directions = np.reshape(np.asarray(directions, dtype=np.float64), (-1, 3))
+    return np.dot(directions, np.asarray(mic_array).T) / speed_of_sound * float(rate)
+
+# Steering table for look directions, shaped (directions, mics, bin_count)
+def make_look_direction_table(directions, bin_count, rate, mic_array=circular_mic_array):
+    return make_steering_table(look_direction_delays(directions, rate, mic_array), bin_count)
+
+# Apply sample delays to a (frames, channels, bins) STFT in one operation.
+# Either pass delays that broadcast to (frames, channels), or a table from
+# make_steering_table and integer table_index that broadcasts to
+# (frames, channels) selecting the row of the table to apply.
+def steer_frames(X, delays=None, table=None, table_index=None):
+    X = np.asarray(X)
+    if table is None:
+        table = make_steering_table(delays, X.shape[-1])
+    elif table_index is not None:
+        table = table[table_index]
+    return X * table
+
+# Delay-and-sum beam outputs for every look direction of a table from
+# make_look_direction_table, shaped (directions, frames, bins)
+def delay_and_sum(X, look_direction_table):
+    return np.einsum('fcb,dcb->dfb', X, look_direction_table) / X.shape[1]
+
+# All pairs (i, j), i < j, of channel_count mics
+def mic_pairs(channel_count):
+    return list(itertools.combinations(range(channel_count), 2))
+
+# GCC-PHAT time difference of arrival estimate for every frame of
+# (channels, samples) wav_data and every mic pair. Returns a
+# (pairs, frames) array of TDOAs in samples, positive when mic i of a pair
+# receives the sound after mic j, in the format output_tdoa_graph takes.
+# Peaks are refined with parabolic interpolation to sub-sample accuracy.
+# Frames where either mic of a pair is silent have no peak and give NaN.
+def gcc_phat_tdoa(wav_data, frame_length=512, frame_advance=256, pairs=None, max_tdoa=None):
+    import audio_wav_utils
+
+    wav_data = np.asarray(wav_data)
+    channel_count, sample_count = wav_data.shape
+    if pairs is None:
+        pairs = mic_pairs(channel_count)
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    if max_tdoa is None:
+        max_tdoa = frame_length - 1
+    max_tdoa = int(min(max_tdoa, frame_length - 1))
+
+    frame_starts = np.arange(0, sample_count - frame_length + 1, frame_advance)
+    if len(frame_starts) == 0:
+        return np.zeros((len(pairs), 0))
+    frames = audio_wav_utils.get_frames(wav_data, frame_starts, frame_length)
+    frames = frames * np.hanning(frame_length)
+
+    fft_length = 2 * frame_length
+    X = np.fft.rfft(frames, fft_length)
+    R = X[:, pairs[:, 0]] * np.conj(X[:, pairs[:, 1]])
+    R /= np.maximum(np.abs(R), np.finfo(float).tiny)
+    # An all-zero cross spectrum leaves cc flat, so argmax would report -max_tdoa
+    silent = ~np.any(R, axis=-1)
+    cc = np.fft.irfft(R, fft_length)
+
+    # One extra lag either side so the peak can always be interpolated
+    lags = np.arange(-max_tdoa - 1, max_tdoa + 2)
+    cc = cc[:, :, lags % fft_length]
+    peak = np.argmax(cc[:, :, 1:-1], axis=-1) + 1
+    left, centre, right = [np.take_along_axis(cc, (peak + o)[..., np.newaxis], axis=-1)[..., 0] for o in (-1, 0, 1)]
+    denominator = left - 2.0 * centre + right
+    offset = np.where(denominator < 0, 0.5 * (left - right) / np.where(denominator < 0, denominator, 1.0), 0.0)
+    return np.where(silent, np.nan, lags[peak] + offset).T
+
+# As gcc_phat_tdoa but reads a wav file a chunk of frames_per_chunk frames at
+# a time, yielding (pairs, frames) arrays that together cover the file
+def iter_gcc_phat_tdoa(filename, frame_length=512, frame_advance=256, pairs=None, max_tdoa=None,
+                       frames_per_chunk=1024):
+    import audio_wav_utils
+
+    with audio_wav_utils.WavFile(filename) as wav:
+        frame_count = max((wav.get_num_frames() - frame_length) // frame_advance + 1, 0)
+        for first_frame in range(0, frame_count, frames_per_chunk):
+            chunk_frames = min(frames_per_chunk, frame_count - first_frame)
+            chunk = wav.read_audio(first_frame * frame_advance,
+                                   (chunk_frames - 1) * frame_advance + frame_length)
+            yield gcc_phat_tdoa(chunk, frame_length, frame_advance, pairs, max_tdoa)
+
+# GCC-PHAT TDOAs of a whole wav file, streamed in chunks
+def gcc_phat_tdoa_file(filename, frame_length=512, frame_advance=256, pairs=None, max_tdoa=None,
+                       frames_per_chunk=1024):
+    import audio_wav_utils
+
+    chunks = list(iter_gcc_phat_tdoa(filename, frame_length, frame_advance, pairs, max_tdoa, frames_per_chunk))
+    if not chunks:
+        channel_count = audio_wav_utils.WavFile(filename).num_channels
+        return np.zeros((len(pairs if pairs is not None else mic_pairs(channel_count)), 0))
+    return np.hstack(chunks)
+
+def _tdoa_panel(gcc_results, max_spread):
+    return {'series': gcc_results,
+            'labels': ['ch ' + str(c) for c in range(len(gcc_results))],
+            'ylim': (-max_spread, max_spread),
+            'title': 'TDOA',
+            'xlabel': 'frame number',
+            'ylabel': 'TDOA (samples)'}
+
 def output_tdoa_graph(gcc_results, filename, max_spread = 2.0):
-    plt.clf()
-    plt.cla()
-    for c in range(len(gcc_results)):
-        plt.plot( gcc_results[c], label='ch ' + str(c))
-    plt.ylim(-max_spread, max_spread)
-    plt.title('TDOA')
-    plt.legend()
-    plt.xlabel('frame number')
-    plt.ylabel('TDOA (samples)')
-    plt.savefig(filename, dpi=100)  
+    import plot_utils
+    plot_utils.save_figure(filename, [_tdoa_panel(gcc_results, max_spread)], dpi=100)
     return
 
 def output_multiple_tdoa_graphs(multiple_gcc_results, filename, max_spread = 2.0):
-    plt.clf()
-    plt.cla()
-    for g in range(len(multiple_gcc_results)):
-        plt.subplot(len(multiple_gcc_results), 1, g+1)
-        for c in range(len(multiple_gcc_results[g])):
-            plt.plot( multiple_gcc_results[g][c], label='ch ' + str(c))
-        plt.ylim(-max_spread, max_spread)
-        plt.title('TDOA')
-        plt.legend()
-        plt.xlabel('frame number')
-        plt.ylabel('TDOA (samples)')
-    plt.savefig(filename, dpi=100)  
+    import plot_utils
+    panels = [_tdoa_panel(gcc_results, max_spread) for gcc_results in multiple_gcc_results]
+    plot_utils.save_figure(filename, panels, dpi=100)
     return
 
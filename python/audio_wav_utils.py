@@ -10,12 +10,22 @@ from pathlib import Path
 import contextlib
 import numpy as np
 import scipy.io.wavfile
-import pandas
 import subprocess
 import re
 import socket
 import time
 import os
+import hashlib
+import struct
+import tempfile
+import common_utils
+
+# Where load_audio keeps decoded audio when asked to cache it, and the total
+# size the cache is allowed to grow to before the least recently used entries
+# are deleted
+AUDIO_CACHE_DIR = os.environ.get("ATT_AUDIO_CACHE_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".cache", "audio_test_tools"))
+AUDIO_CACHE_MAX_BYTES = 4 * 2**30
 
 def get_channel_count(wav_file):
     s = np.shape(wav_file)
@@ -25,8 +35,37 @@ def get_channel_count(wav_file):
         channel_count = len(wav_file[0])
     return channel_count
     
-# This converts a wav file opened with scipy.io.wavfile
-def parse_audio(wav_file):
+# This converts raw samples as read by scipy.io.wavfile to floats in [-1, 1]
+# of the given dtype. If out is given the result is written into it, which
+# lets callers reuse one buffer across many frames.
+def normalise_audio(wav_data, out=None, dtype=np.float64):
+    data_type = wav_data.dtype
+
+    if out is None:
+        out = np.empty(wav_data.shape, dtype=dtype)
+
+    if data_type in (np.int8, np.int16, np.int32):
+        max_val = np.iinfo(data_type).max
+        np.divide(wav_data, float(max_val), out=out)
+    elif data_type == np.uint8:
+        max_val = np.iinfo(np.uint8).max
+        min_val = np.iinfo(np.uint8).min
+        mid = ((max_val - min_val) // 2) + 1
+        out[...] = wav_data
+        out -= mid
+        out /= float(max_val-mid)
+    elif data_type in (np.float32, np.float64):
+        out[...] = wav_data
+    else:
+        print ("Error: unknown data type for parse_audio() " + str(data_type))
+        return wav_data
+
+    return out
+
+
+# This converts a wav file opened with scipy.io.wavfile. Use dtype=np.float32
+# to halve the memory used by the converted data.
+def parse_audio(wav_file, dtype=np.float64):
     channel_count = get_channel_count(wav_file)
     file_length = len(wav_file)
 
@@ -35,34 +74,67 @@ def parse_audio(wav_file):
 
     wav_data = wav_file.T
 
-    # assume at least one sample in at least one channel!
-    data_type = type(wav_data[0][0])
-
-    if data_type == np.int16:
-        max_val = np.iinfo(np.int16).max
-        wav_data = wav_data.astype(dtype=np.float64)/float(max_val)
-    elif data_type == np.int8:
-        max_val = np.iinfo(np.int8).max
-        wav_data = wav_data.astype(dtype=np.float64)/float(max_val)
-    elif data_type == np.int32:
-        max_val = np.iinfo(np.int32).max
-        wav_data = wav_data.astype(dtype=np.float64)/float(max_val)
-    elif data_type == np.uint8:
-        max_val = np.iinfo(np.uint8).max
-        min_val = np.iinfo(np.uint8).min
-        mid = ((max_val - min_val) // 2) + 1
-        wav_data = (wav_data.astype(dtype=np.float64) - mid)/float(max_val-mid)
-    elif data_type == np.float32:
-        wav_data = wav_data.astype(dtype=np.float64)
-    elif  data_type == np.float64:
-        pass
-    else:
-        print ("Error: unknown data type for parse_audio() " + str(data_type))
+    if wav_data.dtype == dtype:
+        return wav_data, channel_count, file_length
+
+    wav_data = normalise_audio(wav_data, dtype=dtype)
 
     return wav_data, channel_count, file_length
 
 
 
+def load_audio(filename, cache=False, dtype=np.float64):
+    """ Reads a wav file and converts it with parse_audio
+
+    If cache is True the converted, channel-major data is saved as a .npy
+    file in AUDIO_CACHE_DIR, keyed on the file's path, size, modification
+    time and output dtype. Later calls return it memory-mapped instead of
+    decoding the wav again.
+
+    Returns the sample rate followed by the outputs of parse_audio.
+    """
+    # WavFile memory-maps the data like scipy's mmap mode but also reads
+    # 24 bit files, which scipy can only read without mmap
+    with WavFile(filename) as wav:
+        rate = wav.sample_rate
+        wav_file = wav.read()
+    if not cache:
+        wav_data, channel_count, file_length = parse_audio(wav_file, dtype)
+        return rate, wav_data, channel_count, file_length
+
+    stat = os.stat(filename)
+    key = "%s|%d|%d|%s" % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                           np.dtype(dtype).name)
+    cache_file = os.path.join(AUDIO_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy")
+
+    if os.path.isfile(cache_file):
+        try:
+            wav_data = np.load(cache_file, mmap_mode="r")
+        except (OSError, ValueError):
+            wav_data = None
+        if wav_data is not None:
+            # Mark as recently used
+            os.utime(cache_file)
+            return rate, wav_data, len(wav_data), wav_data.shape[1]
+
+    wav_data, channel_count, file_length = parse_audio(wav_file, dtype)
+    try:
+        os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=AUDIO_CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(wav_data))
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        common_utils.prune_cache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, "*.npy")
+    except OSError:
+        pass
+
+    return rate, wav_data, channel_count, file_length
+
+
 def convert_to_32_bit(wav_data):
     if wav_data.dtype == np.int32:
         return wav_data
@@ -71,60 +143,85 @@ def convert_to_32_bit(wav_data):
 
 #Return the time domain data extracted 
 def get_frame(wav_data, frame_start, data_length, delays = None):
-    
+    frame = get_frames(wav_data, [frame_start], data_length, delays)[0]
+    return frame.astype(np.float64, copy=False)
+
 
+# Return a (frames, channels, data_length) array of the frames starting at each
+# of frame_starts. Channel ch of each frame starts delays[ch] samples earlier;
+# anything before the start or after the end of wav_data is zero-padded.
+def get_frames(wav_data, frame_starts, data_length, delays = None):
     channel_count = len(wav_data)
+    file_length = wav_data.shape[1]
 
     if delays is None:
         delays = np.zeros(channel_count, dtype= int)
 
-    start_index = frame_start - np.asarray(delays, dtype= int)
-    frame = np.zeros((channel_count, data_length), dtype=np.float64)
-    for ch in range(channel_count):
-        if start_index[ch] < 0 :
-            if start_index[ch] + data_length > 0:
-                frame[ch][ -start_index[ch]:] =  wav_data[ch][:start_index[ch] + data_length]
-        else:
-           frame[ch] = wav_data[ch, start_index[ch]:start_index[ch] + data_length]
-    return frame
+    start_index = (np.asarray(frame_starts, dtype= int)[:, np.newaxis]
+                   - np.asarray(delays, dtype= int)[np.newaxis, :])
+    sample_index = start_index[:, :, np.newaxis] + np.arange(data_length)
+    in_range = (sample_index >= 0) & (sample_index < file_length)
+    np.clip(sample_index, 0, max(file_length - 1, 0), out=sample_index)
 
+    channel_index = np.arange(channel_count)[np.newaxis, :, np.newaxis]
+    frames = wav_data[channel_index, sample_index]
+    frames[~in_range] = 0
+    return frames
 
-def get_erle(in_filename, out_filename, step_size, ch_number):
-    in_rate, in_wav_file = scipy.io.wavfile.read(in_filename)
-    out_rate, out_wav_file = scipy.io.wavfile.read(out_filename)
 
-    in_wav_data, in_channel_count, in_file_length = parse_audio(in_wav_file)
-    out_wav_data, out_channel_count, out_file_length = parse_audio(out_wav_file)
+def get_erle(in_filename, out_filename, step_size, ch_number, cache=False, dtype=np.float64):
+    in_rate, in_wav_data, in_channel_count, in_file_length = load_audio(in_filename, cache, dtype)
+    out_rate, out_wav_data, out_channel_count, out_file_length = load_audio(out_filename, cache, dtype)
 
     in_data_trimmed = np.trim_zeros(in_wav_data[ch_number,:], trim='f')
     out_data_trimmed = np.trim_zeros(out_wav_data[ch_number,:], trim='f')
 
     sample_count = min(len(in_data_trimmed), len(out_data_trimmed))
-    erle = []
-    for index in range(0, sample_count-step_size, step_size):
-        # Calculate EWM of audio power in 1s window
-        in_power = np.power(in_data_trimmed[index:index+step_size], 2)
-        out_power = np.power(out_data_trimmed[index:index+step_size], 2)
-        in_power_ewm = pandas.Series(in_power).ewm(span=step_size).mean()
-        out_power_ewm = pandas.Series(out_power).ewm(span=step_size).mean()
-
-        # Get sum of average power
-        in_power_sum = 0
-        out_power_sum = 0
-        for i in range(len(out_power_ewm)):
-            in_power_sum += in_power_ewm[i]
-            out_power_sum += out_power_ewm[i]
-        next_erle = 10 * np.log10(in_power_sum/out_power_sum) if out_power_sum != 0 else 1000000
-        erle.append(next_erle)
-
-    return erle
-
-
-def iter_frames(input_wav, frame_advance):
+    window_count = len(range(0, sample_count-step_size, step_size))
+    if window_count == 0:
+        return []
+
+    # Calculate EWM of audio power in 1s window
+    in_power = np.reshape(in_data_trimmed[:window_count*step_size]**2, (window_count, step_size))
+    out_power = np.reshape(out_data_trimmed[:window_count*step_size]**2, (window_count, step_size))
+    in_power_sum = _sum_ewm_mean(in_power, step_size)
+    out_power_sum = _sum_ewm_mean(out_power, step_size)
+
+    # Get ratio of the sums of average power
+    erle = np.full(window_count, 1000000.0, dtype=dtype)
+    nonzero = out_power_sum != 0
+    with np.errstate(divide='ignore'):
+        erle[nonzero] = 10 * np.log10(in_power_sum[nonzero]/out_power_sum[nonzero])
+
+    return erle.tolist()
+
+
+# Sum over each row of the adjusted exponentially weighted mean with the given
+# span, matching pandas.Series(row).ewm(span=span).mean().sum()
+def _sum_ewm_mean(power, span):
+    import scipy.signal
+
+    decay = 1.0 - 2.0 / (span + 1.0)
+    weighted_sum = scipy.signal.lfilter(np.ones(1, dtype=power.dtype),
+                                        np.asarray([1.0, -decay], dtype=power.dtype), power, axis=-1)
+    weight_total = np.cumsum(decay ** np.arange(power.shape[-1])).astype(power.dtype)
+    return np.sum(weighted_sum / weight_total, axis=-1)
+
+
+def iter_frames(input_wav, frame_advance, streaming=False, reuse_buffer=False, dtype=np.float64):
     """ Generator that iterates through a wav in `frame_advance` chunks
 
     input_wav
         A Path-like, output from scipy.io.wavfile.read, or output from soundfile.read
+    streaming
+        If True the wav is memory-mapped and each frame is converted to
+        float only when it is read, so memory use does not grow with the
+        file length. Float64 input is yielded as a view.
+    reuse_buffer
+        If True (and streaming) every frame is written into the same
+        buffer. Copy a frame if it needs to outlive the next iteration.
+    dtype
+        The float type of the frames.
     """
     try:
         is_file = Path(input_wav).exists()
@@ -133,15 +230,235 @@ def iter_frames(input_wav, frame_advance):
 
     if is_file:
         # Load the wav
-        _, input_wav_data = scipy.io.wavfile.read(input_wav, 'r')
+        _, input_wav_data = scipy.io.wavfile.read(input_wav, mmap=True)
     else:
         input_wav_data = input_wav
 
-    input_data, input_channel_count, file_length = parse_audio(input_wav_data)
+    if not streaming:
+        input_data, input_channel_count, file_length = parse_audio(input_wav_data, dtype)
+
+        for frame_start in range(0, file_length-frame_advance, frame_advance):
+            new_frame = get_frames(input_data, [frame_start], frame_advance)[0]
+            yield frame_start, new_frame
+        return
+
+    channel_count = get_channel_count(input_wav_data)
+    file_length = len(input_wav_data)
+    if len(input_wav_data.shape) == 1:
+        input_wav_data = np.reshape(input_wav_data, (file_length, 1))
 
+    frame = None
     for frame_start in range(0, file_length-frame_advance, frame_advance):
-        new_frame = get_frame(input_data, frame_start, frame_advance)
-        yield frame_start, new_frame
+        raw_frame = input_wav_data[frame_start:frame_start+frame_advance].T
+        if raw_frame.dtype == dtype:
+            yield frame_start, raw_frame
+            continue
+        if frame is None or not reuse_buffer:
+            frame = np.empty((channel_count, frame_advance), dtype=dtype)
+        yield frame_start, normalise_audio(raw_frame, out=frame)
+
+
+class WavFileException(Exception):
+    """ Exception class for wav file parsing errors """
+    pass
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+
+class WavFile:
+    """ Random access reader for PCM and IEEE float wav files
+
+    This is the Python counterpart of att_get_wav_header_details,
+    att_wav_get_num_frames and att_wav_get_frame_start. The RIFF chunks are
+    walked to find `fmt ` and `data`, skipping any other chunks, and
+    WAVE_FORMAT_EXTENSIBLE headers are resolved to their sub-format. The
+    data chunk is memory-mapped so any range of frames or subset of
+    channels can be read without touching the rest of the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        file_size = os.path.getsize(filename)
+
+        with open(filename, "rb") as f:
+            riff_header, wav_size, wave_header = struct.unpack("<4sI4s", f.read(12))
+            if riff_header != b"RIFF":
+                raise WavFileException("couldn't find RIFF in %s" % filename)
+            if wave_header != b"WAVE":
+                raise WavFileException("couldn't find WAVE in %s" % filename)
+
+            fmt_chunk = None
+            self.header_size = None
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+                if chunk_id == b"fmt ":
+                    fmt_chunk = f.read(chunk_size)
+                elif chunk_id == b"data":
+                    self.header_size = f.tell()
+                    # Recorders that are stopped early can leave the size
+                    # unset (0 or 0xffffffff), so then read to the end of
+                    # the file. Otherwise don't read past it if truncated.
+                    self.data_bytes = file_size - self.header_size
+                    if chunk_size not in (0, 0xffffffff):
+                        self.data_bytes = min(chunk_size, self.data_bytes)
+                    break
+                else:
+                    f.seek(chunk_size, os.SEEK_CUR)
+                # Chunks are padded to an even number of bytes
+                if chunk_size % 2:
+                    f.seek(1, os.SEEK_CUR)
+
+        if fmt_chunk is None:
+            raise WavFileException("couldn't find fmt in %s" % filename)
+        if self.header_size is None:
+            raise WavFileException("couldn't find data in %s" % filename)
+
+        (self.audio_format, self.num_channels, self.sample_rate, self.byte_rate,
+         self.sample_alignment, self.bit_depth) = struct.unpack("<HHIIHH", fmt_chunk[:16])
+        if self.audio_format == WAVE_FORMAT_EXTENSIBLE:
+            # The first 2 bytes of the sub-format GUID is the audio_format
+            self.audio_format, = struct.unpack("<H", fmt_chunk[24:26])
+
+        bytes_per_sample = self.sample_alignment // self.num_channels
+        if self.audio_format == WAVE_FORMAT_PCM and bytes_per_sample in (1, 2, 3, 4):
+            self.dtype = np.dtype({1: "u1", 2: "<i2", 3: "<i4", 4: "<i4"}[bytes_per_sample])
+        elif self.audio_format == WAVE_FORMAT_IEEE_FLOAT and bytes_per_sample in (4, 8):
+            self.dtype = np.dtype({4: "<f4", 8: "<f8"}[bytes_per_sample])
+        else:
+            raise WavFileException("audio format(%d) with %d bit samples is not supported"
+                                   % (self.audio_format, self.bit_depth))
+
+        num_frames = self.get_num_frames()
+        if bytes_per_sample == 3:
+            self._data = np.memmap(filename, dtype=np.uint8, mode="r", offset=self.header_size,
+                                   shape=(num_frames, self.num_channels, 3))
+        elif num_frames > 0:
+            self._data = np.memmap(filename, dtype=self.dtype, mode="r", offset=self.header_size,
+                                   shape=(num_frames, self.num_channels))
+        else:
+            self._data = np.zeros((0, self.num_channels), dtype=self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._data = None
+
+    def get_num_bytes_per_frame(self):
+        return self.sample_alignment
+
+    def get_num_frames(self):
+        return self.data_bytes // self.get_num_bytes_per_frame()
+
+    def get_frame_start(self, frame_number):
+        """ Returns the byte offset of a frame within the file """
+        return self.header_size + frame_number * self.get_num_bytes_per_frame()
+
+    def read(self, frame_start=0, frame_count=None, channels=None):
+        """ Returns frame_count frames from frame_start as a (frames, channels)
+        array of raw samples, in the same layout as scipy.io.wavfile.read.
+
+        channels may be an index, a slice or a list of indices. For slices
+        the result is a view of the memory-mapped file. 24 bit samples are
+        returned in the top bytes of int32s. """
+        if frame_count is None:
+            frame_count = self.get_num_frames() - frame_start
+        if channels is None:
+            channels = slice(None)
+        if isinstance(channels, int):
+            channels = [channels]
+
+        samples = self._data[frame_start:frame_start + frame_count, channels]
+        if self.sample_alignment // self.num_channels == 3:
+            samples = samples.astype(np.int32)
+            samples = (samples[..., 0] << 8) | (samples[..., 1] << 16) | (samples[..., 2] << 24)
+        return samples
+
+    def read_seconds(self, start_seconds=0.0, duration_seconds=None, channels=None):
+        """ As read() but with the range given in seconds """
+        frame_start = int(start_seconds * self.sample_rate)
+        frame_count = None
+        if duration_seconds is not None:
+            frame_count = int(duration_seconds * self.sample_rate)
+        return self.read(frame_start, frame_count, channels)
+
+    def read_audio(self, frame_start=0, frame_count=None, channels=None, dtype=np.float64):
+        """ As read() but converted with parse_audio to channel-major floats """
+        wav_data, _, _ = parse_audio(self.read(frame_start, frame_count, channels), dtype)
+        return wav_data
+
+
+class WavWriter:
+    """ Incremental wav writer
+
+    Samples are appended with write() as they are generated and the RIFF
+    and data chunk sizes are fixed up by close(), so the whole signal never
+    has to be held in memory. The header is the same as the one written by
+    scipy.io.wavfile.write.
+    """
+
+    def __init__(self, filename, sample_rate, num_channels, dtype=np.int32):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.num_frames = 0
+
+        is_float = self.dtype.kind == "f"
+        bit_depth = self.dtype.itemsize * 8
+        fmt_chunk = struct.pack("<HHIIHH", WAVE_FORMAT_IEEE_FLOAT if is_float else WAVE_FORMAT_PCM,
+                                num_channels, sample_rate, sample_rate * num_channels * bit_depth // 8,
+                                num_channels * bit_depth // 8, bit_depth)
+        if is_float:
+            # add cbSize field for non-PCM files
+            fmt_chunk += b"\x00\x00"
+
+        self._file = open(filename, "wb")
+        self._file.write(b"RIFF\x00\x00\x00\x00WAVE")
+        self._file.write(b"fmt " + struct.pack("<I", len(fmt_chunk)) + fmt_chunk)
+        self._fact_position = None
+        if is_float:
+            self._fact_position = self._file.tell() + 8
+            self._file.write(b"fact" + struct.pack("<II", 4, 0))
+        self._file.write(b"data\x00\x00\x00\x00")
+        self.header_size = self._file.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, samples):
+        """ Appends a (frames, channels) block of samples, or a 1D block
+        for mono files """
+        samples = np.asarray(samples, dtype=self.dtype)
+        samples = np.reshape(samples, (-1, self.num_channels))
+        samples.tofile(self._file)
+        self.num_frames += len(samples)
+
+    def close(self):
+        if self._file is None:
+            return
+        data_bytes = self._file.tell() - self.header_size
+        self._file.seek(4)
+        self._file.write(struct.pack("<I", min(self.header_size + data_bytes - 8, 0xffffffff)))
+        if self._fact_position is not None:
+            self._file.seek(self._fact_position)
+            self._file.write(struct.pack("<I", self.num_frames))
+        self._file.seek(self.header_size - 4)
+        self._file.write(struct.pack("<I", min(data_bytes, 0xffffffff)))
+        self._file.close()
+        self._file = None
 
 
 @contextlib.contextmanager
@@ -0,0 +1,91 @@
+# Copyright 2026 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+""" Checks that importing each module stays within its start-up budget.
+
+Each module is imported in a fresh interpreter, which must not load any of
+the heavy dependencies in DEFERRED_MODULES; those should only be imported
+by the functions that use them. This check does not depend on the speed of
+the machine. The cumulative import time of the module (including everything
+it imports) is also measured with `-X importtime` and compared with its
+budget, scaled by --scale for slower machines.
+
+Run by CI. Exits non-zero if any module loads a deferred dependency or is
+over budget.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Budgets in milliseconds, including numpy where the module needs it
+IMPORT_TIME_BUDGETS_MS = {
+    "common_utils": 300,
+    "audio_wav_utils": 600,
+    "audio_utils": 300,
+    "audio_generation": 600,
+    "wav_comp": 800,
+    "test_wav_erle": 600,
+    "thdncalculator": 300,
+    "hardware_test_tools": 600,
+}
+
+# Modules which must not be loaded just by importing any module above
+DEFERRED_MODULES = ["matplotlib", "pandas", "scipy.signal", "soundfile", "scikits", "pyximport"]
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs='*', help="modules to check, default all", default=sorted(IMPORT_TIME_BUDGETS_MS))
+    parser.add_argument("--repeats", help="imports per module, the fastest is used", type=int, default=3)
+    parser.add_argument("--scale", help="multiply every budget by this, for slow machines", type=float, default=1.0)
+    args = parser.parse_args()
+    return args
+
+
+def get_import_time_ms(module):
+    """ Returns the cumulative import time of module in milliseconds """
+    ret = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         cwd=package_dir, capture_output=True, text=True)
+    if ret.returncode != 0:
+        raise RuntimeError("Failed to import %s:\n%s" % (module, ret.stderr))
+    for line in ret.stderr.splitlines():
+        found = re.match(r"import time:\s*\d+\s*\|\s*(\d+)\s*\|\s*" + re.escape(module) + r"\s*$", line)
+        if found:
+            return int(found.group(1)) / 1000.0
+    raise RuntimeError("No import time reported for %s" % module)
+
+
+def get_deferred_modules_loaded(module):
+    """ Returns the DEFERRED_MODULES loaded by importing module """
+    code = "import sys, %s; print(' '.join(m for m in %r if m in sys.modules))" % (module, DEFERRED_MODULES)
+    ret = subprocess.run([sys.executable, "-c", code], cwd=package_dir, capture_output=True, text=True)
+    if ret.returncode != 0:
+        raise RuntimeError("Failed to import %s:\n%s" % (module, ret.stderr))
+    return ret.stdout.split()
+
+
+def check_import_times(modules, repeats=3, scale=1.0):
+    all_ok = True
+    for module in modules:
+        loaded = get_deferred_modules_loaded(module)
+        import_time_ms = min(get_import_time_ms(module) for _ in range(repeats))
+        budget_ms = IMPORT_TIME_BUDGETS_MS[module] * scale
+        ok = not loaded and import_time_ms <= budget_ms
+        all_ok = all_ok and ok
+        status = "OK"
+        if loaded:
+            status = "LOADS " + ", ".join(loaded)
+        elif import_time_ms > budget_ms:
+            status = "OVER BUDGET"
+        print("%-22s %8.1f ms / %6.1f ms %s" % (module, import_time_ms, budget_ms, status))
+    return all_ok
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    sys.exit(0 if check_import_times(args.modules, args.repeats, args.scale) else 1)
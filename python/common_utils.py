@@ -7,6 +7,7 @@ from __future__ import print_function
 
 import os
 import re
+import glob
 import configparser
 import ast
 import numpy as np
@@ -42,3 +43,26 @@ def select_process_channels(y_wav_data, channels_to_process):
         y_wav_data = y_wav_data[channels_to_process]
 
     return y_wav_data, y_channel_count
+
+
+def prune_cache(cache_dir, max_bytes, pattern="*"):
+    """ Deletes the least recently used files matching pattern in cache_dir
+    until their total size is no more than max_bytes. A file's modification
+    time is taken as its last use, so touch files when they are read. """
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, pattern)):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_bytes -= size
@@ -5,31 +5,47 @@ import subprocess
 import sys
 import re
 from contextlib import contextmanager
+import functools
 import re
 
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.io.wavfile
 from time import sleep
 from pathlib import Path
 import random
 from sys import platform
-from .prepare_hw_test_wav import gen_pdm_and_pack_ref
 import math
 
 APP_NAME = "app_xk_xvf3510_l71"
-XMOS_ROOT = Path(os.environ["XMOS_ROOT"])
-SW_XVF3510 = XMOS_ROOT / "sw_xvf3510"
-APP_PATH = SW_XVF3510 / APP_NAME
-SRC_TEST_PATH = SW_XVF3510 / "tests/src_test"
-
-host_utility_locations = {
-    "vfctrl_usb": APP_PATH / "host" / "dsp_control",
-    "vfctrl_json": APP_PATH / "host" / "dsp_control",
-    "data_partition_generator": XMOS_ROOT / "lib_flash_data_partition" / "host" / "data_partition_generator",
-    "dfu_suffix_generator": XMOS_ROOT / "lib_dfu" / "host" / "suffix_generator",
-    "dfu_usb": APP_PATH / "host" / "dfu_control"
-}
+
+@functools.lru_cache(maxsize=None)
+def _paths():
+    """ Sandbox locations, looked up on first use so that the module can be
+    imported without XMOS_ROOT being set """
+    XMOS_ROOT = Path(os.environ["XMOS_ROOT"])
+    SW_XVF3510 = XMOS_ROOT / "sw_xvf3510"
+    APP_PATH = SW_XVF3510 / APP_NAME
+    SRC_TEST_PATH = SW_XVF3510 / "tests/src_test"
+
+    host_utility_locations = {
+        "vfctrl_usb": APP_PATH / "host" / "dsp_control",
+        "vfctrl_json": APP_PATH / "host" / "dsp_control",
+        "data_partition_generator": XMOS_ROOT / "lib_flash_data_partition" / "host" / "data_partition_generator",
+        "dfu_suffix_generator": XMOS_ROOT / "lib_dfu" / "host" / "suffix_generator",
+        "dfu_usb": APP_PATH / "host" / "dfu_control"
+    }
+    return {
+        "XMOS_ROOT": XMOS_ROOT,
+        "SW_XVF3510": SW_XVF3510,
+        "APP_PATH": APP_PATH,
+        "SRC_TEST_PATH": SRC_TEST_PATH,
+        "host_utility_locations": host_utility_locations,
+    }
+
+def __getattr__(name):
+    # Keeps XMOS_ROOT, APP_PATH etc. available as module attributes
+    if name in ("XMOS_ROOT", "SW_XVF3510", "APP_PATH", "SRC_TEST_PATH", "host_utility_locations"):
+        return _paths()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class HardwareTestException(Exception):
     """ Exception class for Hardware Test errors """
@@ -45,7 +61,7 @@ def pushd(new_dir):
         os.chdir(last_dir)
 
 def get_firmware_version():
-    with pushd(SW_XVF3510):
+    with pushd(_paths()["SW_XVF3510"]):
         changelog_file = Path("CHANGELOG.rst")
         assert changelog_file.is_file()
         with open(changelog_file) as c:
@@ -71,6 +87,7 @@ def prepare_firmware(host, xe_path=None, data_partition_image=None, build_flags=
     check_bld_message(host, rand_str)
 
 def build_host(extra_utilities):
+    host_utility_locations = _paths()["host_utility_locations"]
     binaries = {}
     for utility in ["vfctrl_usb"] + extra_utilities:
         CMakeCache_file = host_utility_locations[utility] / "CMakeCache.txt"
@@ -92,6 +109,7 @@ def build_host(extra_utilities):
 def build_firmware(verbose=False, build_flags="", config="usb_adaptive", blank=False):
     if blank:
         return None
+    APP_PATH = _paths()["APP_PATH"]
     print("Building firmware...")
     with pushd(APP_PATH):
         args = f"configure clean build -j1 --config {config} {build_flags}"
@@ -101,6 +119,7 @@ def build_firmware(verbose=False, build_flags="", config="usb_adaptive", blank=F
     return APP_PATH / "bin" / "app_xk_xvf3510_l71_usb_adaptive.xe"
 
 def build_src_xe(verbose=False):
+    SRC_TEST_PATH = _paths()["SRC_TEST_PATH"]
     print("Building src xe...")
     with pushd(SRC_TEST_PATH):
         args = f"configure clean build"
@@ -127,7 +146,7 @@ def erase_flash(xn_file):
     subprocess.run(["xflash", "--erase-all", "--target-file", xn_file])
 
 def build_data_image(host, which, compatibility_ver=None, bcd_ver=None, config_file=None, crc_error_data=False, verbose=False):
-    config_path = APP_PATH / "data-partition"
+    config_path = _paths()["APP_PATH"] / "data-partition"
 
     if config_file == None:
         config_file = config_path / "hardware_test.json"
@@ -336,27 +355,35 @@ def play_and_record(play_file, play_device, record_file, record_device, rate=Non
         subprocess.run(["killall", "xplay"])
 
 def prepare_4ch_wav_for_harness(input_file_name, output_file_name = "output.wav"):
+    # Importing this builds the cython helpers, so only do it when needed
+    from .prepare_hw_test_wav import gen_pdm_and_pack_ref
     gen_pdm_and_pack_ref(input_file_name, output_file_name)
     return output_file_name
 
 
 def correlate_and_diff(output_file, input_file, out_ch_start_end, in_ch_start_end, skip_seconds_start, skip_seconds_end, tol, corr_plot_file=None, verbose=False):
-    rate_usb_out, data_out = scipy.io.wavfile.read(output_file)
-    rate_usb_in, data_in = scipy.io.wavfile.read(input_file)
+    import scipy.signal
+    import audio_wav_utils
+
+    # Only the channels and samples that are compared get read from disk
+    wav_out = audio_wav_utils.WavFile(output_file)
+    wav_in = audio_wav_utils.WavFile(input_file)
+    rate_usb_out = wav_out.sample_rate
+    rate_usb_in = wav_in.sample_rate
     print(f"rate_usb_in={rate_usb_in}, rate_usb_out={rate_usb_out}")
     if rate_usb_out != rate_usb_in:
         assert False, "input and output file rates are not equal"
 
     #TODO handle dtypes not being same
-    assert data_in.dtype == data_out.dtype, "input and output data_type are not same"
+    assert wav_in.dtype == wav_out.dtype, "input and output data_type are not same"
 
     assert out_ch_start_end[1]-out_ch_start_end[0] == in_ch_start_end[1]-in_ch_start_end[0], "input and output files have different channel nos."
 
 
     skip_samples_start = int(rate_usb_out * skip_seconds_start)
     skip_samples_end = int(rate_usb_out * skip_seconds_end)
-    data_in = data_in[:,in_ch_start_end[0]:in_ch_start_end[1]+1]
-    data_out = data_out[:,out_ch_start_end[0]:out_ch_start_end[1]+1]
+    data_in = wav_in.read(channels=slice(in_ch_start_end[0], in_ch_start_end[1]+1))
+    data_out = wav_out.read(channels=slice(out_ch_start_end[0], out_ch_start_end[1]+1))
 
     data_in_small = data_in[skip_samples_start:64000+skip_samples_start, :].astype(np.float64)
     data_out_small = data_out[skip_samples_start:64000+skip_samples_start, :].astype(np.float64)
@@ -367,9 +394,8 @@ def correlate_and_diff(output_file, input_file, out_ch_start_end, in_ch_start_en
     print(f"delay = {delay}")
 
     if corr_plot_file != None:
-        plt.plot(corr)
-        plt.savefig(corr_plot_file)
-        plt.clf()
+        import plot_utils
+        plot_utils.save_figure(corr_plot_file, [{'series': [corr]}])
     delay_orig = delay
 
     #assert if output is ahead of the input
@@ -429,9 +455,14 @@ def correlate_and_diff(output_file, input_file, out_ch_start_end, in_ch_start_en
 # for example when we see a 3kHz sine wave sampled at 16kHz. You get patter repeating every 3 whole cycles
 # In the frequency domain it's all fine but in time domain you need to expect that the PCM samples will
 # vary over 3 cycles in a repeated pattern.
-def analyse_sine_rms(input_file, in_channel, num_half_cycles_per_rms, verbose=False):
-    rate_usb_in, data_in = scipy.io.wavfile.read(input_file)
-    audio = data_in[:,in_channel].astype(np.float64) / 2**31
+# Use dtype=np.float32 to halve the memory used for long captures.
+def analyse_sine_rms(input_file, in_channel, num_half_cycles_per_rms, verbose=False, dtype=np.float64):
+    import audio_wav_utils
+
+    # Only the analysed channel is read; WavFile also handles 24 bit captures
+    with audio_wav_utils.WavFile(input_file) as wav_in:
+        rate_usb_in = wav_in.sample_rate
+        audio = wav_in.read(channels=in_channel)[:, 0].astype(dtype) / dtype(2**31)
 
     print(f"Computing stats on {audio.shape[0]} samples")
 
@@ -488,13 +519,13 @@ def analyse_sine_rms(input_file, in_channel, num_half_cycles_per_rms, verbose=Fa
 
     return rms_array.mean(), rms_array.max(), rms_array.min(), measured_freq
 
-def is_sine_good(input_file, channel, expected_hz, sine_peak_amplitude, rtol=0.0001, rtol_gain=0.1, verbose=False, num_half_cycles_per_rms=1):
+def is_sine_good(input_file, channel, expected_hz, sine_peak_amplitude, rtol=0.0001, rtol_gain=0.1, verbose=False, num_half_cycles_per_rms=1, dtype=np.float64):
     # Note we don't use abs_tol as numbers are never normally close to zero so leave as default zero
     expected_rms = sine_peak_amplitude / math.sqrt(2)
 
     if verbose:
         print(f"Analysing file {input_file}, channel {channel}")
-    mean_rms, max_rms, min_rms, measured_freq = analyse_sine_rms(input_file, channel, num_half_cycles_per_rms, verbose=False)
+    mean_rms, max_rms, min_rms, measured_freq = analyse_sine_rms(input_file, channel, num_half_cycles_per_rms, verbose=False, dtype=dtype)
 
     if verbose:
         print(f"Expected RMS: {expected_rms}, mean RMS: {mean_rms}, max RMS: {max_rms}, min RMS: {min_rms}")
@@ -515,12 +546,12 @@ def is_sine_good(input_file, channel, expected_hz, sine_peak_amplitude, rtol=0.0
     return dropout_ok and injected_noise_ok and gain_ok
 
 def get_app_directory():
-    return str(APP_PATH)
+    return str(_paths()["APP_PATH"])
 
 def reset_target():
     print("Resetting target...")
 
-    subprocess.run(["xgdb", "-batch", "-ex", "connect --reset-to-mode-pins", "-ex", "detach")
+    subprocess.run(["xgdb", "-batch", "-ex", "connect --reset-to-mode-pins", "-ex", "detach"])
 
     # alternative way to reboot using DFU utility
     #host['dfu_usb'].reboot()
@@ -0,0 +1,91 @@
+# Copyright 2026 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+""" Fast line plots of long series for test reports
+
+Figures are drawn with the Agg canvas directly rather than through pyplot,
+so no interactive backend is ever selected and plotting is safe in worker
+processes. Series longer than the figure is wide are reduced to a min/max
+envelope per pixel column before drawing, which keeps every peak visible
+while drawing a few thousand points instead of millions.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+DEFAULT_FIGSIZE = (6.4, 4.8)
+DEFAULT_DPI = 100
+
+
+def min_max_decimate(y, max_points):
+    """ Reduces y to at most max_points points by keeping the minimum and
+    maximum of each of max_points // 2 equal buckets, in the order they
+    occur. Non-finite values are ignored unless a bucket has nothing else.
+
+    Returns the x (sample index) and y values of the kept points. """
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) <= max_points:
+        return np.arange(len(y)), y
+
+    bucket_count = max(max_points // 2, 1)
+    bucket_length = int(np.ceil(len(y) / float(bucket_count)))
+    bucket_count = int(np.ceil(len(y) / float(bucket_length)))
+    finite = np.isfinite(y)
+    padded = np.full(bucket_count * bucket_length, np.nan)
+    padded[:len(y)] = np.where(finite, y, np.nan)
+    buckets = np.reshape(padded, (bucket_count, bucket_length))
+
+    offsets = np.arange(bucket_count) * bucket_length
+    min_index = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1) + offsets
+    max_index = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1) + offsets
+    x = np.sort(np.stack((min_index, max_index), axis=1), axis=1).ravel()
+    x = np.minimum(x, len(y) - 1)
+    return x, y[x]
+
+
+def save_figure(filename, panels, figsize=DEFAULT_FIGSIZE, dpi=DEFAULT_DPI):
+    """ Draws one subplot per panel, one above the other, and saves them.
+
+    Each panel is a dict with a 'series' list of 1D arrays and optionally
+    'labels', 'title', 'xlabel', 'ylabel' and 'ylim'. A legend is drawn
+    when there are labels. """
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    max_points = 2 * int(figsize[0] * dpi)
+
+    for panel_index, panel in enumerate(panels):
+        ax = fig.add_subplot(len(panels), 1, panel_index + 1)
+        labels = panel.get('labels')
+        for series_index, series in enumerate(panel['series']):
+            x, y = min_max_decimate(series, max_points)
+            label = labels[series_index] if labels else None
+            ax.plot(x, y, label=label)
+        if 'ylim' in panel:
+            ax.set_ylim(*panel['ylim'])
+        if 'title' in panel:
+            ax.set_title(panel['title'])
+        if labels:
+            ax.legend()
+        if 'xlabel' in panel:
+            ax.set_xlabel(panel['xlabel'])
+        if 'ylabel' in panel:
+            ax.set_ylabel(panel['ylabel'])
+
+    fig.savefig(filename, dpi=dpi)
+
+
+def _save_figure_job(job):
+    filename, panels, kwargs = job
+    save_figure(filename, panels, **kwargs)
+    return filename
+
+
+def save_figures(figures, processes=None):
+    """ Renders many figures in a process pool.
+
+    figures is a list of (filename, panels) or (filename, panels, kwargs)
+    tuples as taken by save_figure. Returns the filenames in order. """
+    jobs = [(f[0], f[1], f[2] if len(f) > 2 else {}) for f in figures]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_save_figure_job, jobs))
@@ -2,9 +2,7 @@
 # This Software is subject to the terms of the XMOS Public Licence: Version 1.
 import numpy as np
 import scipy.io.wavfile
-import audio_utils as au
 import argparse
-import matplotlib.pyplot as plt
 import audio_wav_utils
 
 def parse_arguments():
@@ -15,56 +13,115 @@ def parse_arguments():
     parser.add_argument("output", nargs='?', help="error (e) and passthrough(x) wav file", default='output.pdf')
     parser.add_argument("--verbose", action='store_true', help="Turn verbose mode on", default=False)
     parser.add_argument("--process_until_frame", help="Process until this frame", type=int, default=-1)
+    parser.add_argument("--float32", action='store_true', help="Measure in single precision", default=False)
     parser.parse_args()
     args = parser.parse_args()
     return args
 
-def test_data(input_wav_data, input_rate, file_length, input_channel_count, verbose = False, process_until_frame = -1, alpha = 0.995):
-
-    frame_len = 240
-
-    total_channel_count = input_wav_data.shape[0]
+class ErleTracker:
+    """ Incremental ERLE measurement over 240 sample frames
+
+    The EWM of each channel's frame power is carried between calls to
+    process(), so a capture can be scored block by block as it is read.
+    Blocks may be any length; samples short of a whole frame are held
+    until the next call.
+    The first `input_channel_count` channels are the input and the next
+    `input_channel_count` channels are the output. The ERLE has the float
+    type of the blocks passed in. """
+
+    def __init__(self, input_channel_count, frame_len=240, alpha=0.995):
+        self.input_channel_count = input_channel_count
+        self.frame_len = frame_len
+        self.alpha = alpha
+        self.frame_count = 0
+        self.filter_state = None
+        self.remainder = None
+
+    def process(self, block, final=False):
+        """ Process a (channels, samples) block and return the ERLE of each
+        frame completed by it as an (input_channel_count, frames) array.
+        Pass final=True with the last block to zero pad and measure any
+        trailing partial frame. """
+        import scipy.signal
+
+        if self.remainder is not None:
+            block = np.hstack((self.remainder, block))
+        total_channel_count, block_length = block.shape
+        if final:
+            block_frames = int(np.ceil(float(block_length) / self.frame_len))
+        else:
+            block_frames = block_length // self.frame_len
+        self.remainder = block[:, block_frames * self.frame_len:] if not final else None
+        if block_frames == 0:
+            return np.zeros((self.input_channel_count, 0), dtype=block.dtype)
+
+        block = block[:, :block_frames * self.frame_len]
+        padding = np.zeros((total_channel_count, block_frames * self.frame_len - block.shape[1]), dtype=block.dtype)
+        framed_block = np.reshape(np.hstack((block, padding)), (total_channel_count, block_frames, self.frame_len))
+
+        frames_power = np.sum(framed_block**2, axis = -1)
+        if self.frame_count == 0:
+            # The EWM starts from zero at the first frame
+            frames_power[:, 0] = 0
+        if self.filter_state is None:
+            self.filter_state = np.zeros((total_channel_count, 1), dtype=frames_power.dtype)
+
+        frames_power_ewm, self.filter_state = scipy.signal.lfilter(
+            np.asarray([1.0 - self.alpha], dtype=frames_power.dtype), np.asarray([1.0, -self.alpha], dtype=frames_power.dtype),
+            frames_power, axis = -1, zi = self.filter_state)
+        self.frame_count += block_frames
+
+        input_energy = frames_power_ewm[:self.input_channel_count]
+        output_energy = frames_power_ewm[self.input_channel_count: 2*self.input_channel_count]
+
+        eps = frames_power_ewm.dtype.type(np.finfo(float).eps)
+        # erle =  -np.where(output_energy>0.0, np.where(input_energy>0.0,10*np.log10((input_energy+eps) / (output_energy+eps)), np.Inf), np.Inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            erle =  np.where(input_energy>0.0, np.where(output_energy>0.0,10*np.log10((output_energy+eps) / (input_energy+eps)), np.inf), 0)
+
+        return erle
 
-    output_frames = int(np.ceil(float(file_length) / frame_len))
-    padding =  np.zeros((total_channel_count, output_frames * frame_len - file_length))
 
-    framed_input_wav_data = np.hstack((input_wav_data, padding))
-
-    framed_input_wav_data = np.reshape(framed_input_wav_data, (total_channel_count, output_frames, frame_len))
-    
-    frames_power = np.sum(framed_input_wav_data**2, axis = -1)
-    
-    frames_power_ewm = np.zeros((total_channel_count, output_frames))
-    for f in range(1, output_frames):
-        frames_power_ewm[:, f] = frames_power_ewm[:, f-1]*alpha + (1.0-alpha) * frames_power[:, f]
+def test_data(input_wav_data, input_rate, file_length, input_channel_count, verbose = False, process_until_frame = -1, alpha = 0.995):
 
-    input_energy = frames_power_ewm[:input_channel_count]
-    output_energy = frames_power_ewm[input_channel_count: 2*input_channel_count]
+    tracker = ErleTracker(input_channel_count, alpha = alpha)
 
+    if process_until_frame >= 0:
+        file_length = min(file_length, process_until_frame * tracker.frame_len)
 
-    eps = np.finfo(float).eps
-    # erle =  -np.where(output_energy>0.0, np.where(input_energy>0.0,10*np.log10((input_energy+eps) / (output_energy+eps)), np.Inf), np.Inf)
-    erle =  np.where(input_energy>0.0, np.where(output_energy>0.0,10*np.log10((output_energy+eps) / (input_energy+eps)), np.Inf), 0)
+    return tracker.process(input_wav_data[:, :file_length], final=True)
 
-    return erle
 
+def test_file(input_file, output_file, input_channel_count, verbose = False, process_until_frame = -1, frames_per_block = 1000, dtype = np.float64):
 
-def test_file(input_file, output_file, input_channel_count, verbose = False, process_until_frame = -1):
+    input_rate, input_wav_file = scipy.io.wavfile.read(input_file, mmap=True)
+    if len(input_wav_file.shape) == 1:
+        input_wav_file = np.reshape(input_wav_file, (len(input_wav_file), 1))
 
-    input_rate, input_wav_file = scipy.io.wavfile.read(input_file, 'r')
-    input_wav_data, total_channel_count, file_length = audio_wav_utils.parse_audio(input_wav_file)
+    tracker = ErleTracker(input_channel_count)
+    file_length = len(input_wav_file)
+    if process_until_frame >= 0:
+        file_length = min(file_length, process_until_frame * tracker.frame_len)
 
-    elre = test_data(input_wav_data, input_rate, file_length, input_channel_count, verbose, process_until_frame)
+    block_length = frames_per_block * tracker.frame_len
+    elre = []
+    for block_start in range(0, file_length, block_length):
+        block_end = min(block_start + block_length, file_length)
+        block = audio_wav_utils.normalise_audio(input_wav_file[block_start:block_end].T, dtype=dtype)
+        elre.append(tracker.process(block, final=block_end == file_length))
+    if elre:
+        elre = np.hstack(elre)
+    else:
+        elre = np.zeros((input_channel_count, 0), dtype=dtype)
 
-    plt.clf()
-    for input_ch in range(input_channel_count):
-        plt.plot(elre[input_ch])
-    plt.savefig(output_file)
+    import plot_utils
+    plot_utils.save_figure(output_file, [{'series': elre[:input_channel_count]}])
 
 if __name__ == "__main__":
     args = parse_arguments()
 
-    test_file(args.input, args.output, int(args.input_channel_count), args.verbose, int(args.process_until_frame))
+    test_file(args.input, args.output, int(args.input_channel_count), args.verbose, int(args.process_until_frame),
+              dtype=np.float32 if args.float32 else np.float64)
 
 
 
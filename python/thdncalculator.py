@@ -1,22 +1,10 @@
 # Copyright 2019-2021 XMOS LIMITED.
 # This Software is subject to the terms of the XMOS Public Licence: Version 1.
 import sys, os
-from scipy.signal import blackmanharris
 from numpy.fft import rfft, irfft
 from numpy import argmax, sqrt, mean, absolute, arange, log10
 import numpy as np
 
-use_soundfile = False
-
-
-try:
-    import soundfile as sf
-    print("using soundfile")
-    use_soundfile = True
-except ImportError:
-    from scikits.audiolab import Sndfile
-    print("using scikits.audiolab")
-
 
 def rms_flat(a, sample_rate):
     """
@@ -54,6 +42,8 @@ def THDN_and_freq(signal, sample_rate):
     out the entire thing.  A fixed-width filter would probably be just as good,
     if not better.
     """
+    from scipy.signal import blackmanharris
+
     # Get rid of DC and window the signal
     signal -= mean(signal) # TODO: Do this in the frequency domain, and take any skirts with it?
     windowed = signal * blackmanharris(len(signal))  # TODO Kaiser?
@@ -93,10 +83,16 @@ def load(filename):
 
     Can be any format that libsndfile supports, like .wav, .flac, etc.
     """
-    if use_soundfile:
+    try:
+        import soundfile as sf
+    except ImportError:
+        sf = None
+
+    if sf is not None:
         wave_file = sf.SoundFile(filename)
         signal = wave_file.read()
     else:
+        from scikits.audiolab import Sndfile
         wave_file = Sndfile(filename, 'r')
         signal = wave_file.read_frames(wave_file.nframes)
 
@@ -4,88 +4,240 @@ from __future__ import division
 from __future__ import print_function
 from builtins import str
 from builtins import range
+from collections import namedtuple
+import hashlib
+import os
 import numpy as np
+import scipy.fft
 import scipy.io.wavfile
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import audio_utils as au
 import audio_wav_utils
+import common_utils
 import argparse
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("a", help="a wav file")
     parser.add_argument("b", help="b wav file")
+    parser.add_argument("--exact", action='store_true', help="Only check the files are bit-exact, using cached block hashes", default=False)
+    parser.add_argument("--float32", action='store_true', help="Compare in single precision to halve memory use", default=False)
     parser.parse_args()
     args = parser.parse_args()
     return args
 
 
-def compare(a_wav_file, b_wav_file):
-   
-    a_wav_data, a_channel_count, a_file_length = audio_wav_utils.parse_audio(a_wav_file)
-    b_wav_data, b_channel_count, b_file_length = audio_wav_utils.parse_audio(b_wav_file)
-    
-    if a_channel_count != b_channel_count:
-        print("Error files are different channel counts")
+#The number of samples of data in the frame
+proc_frame_length = 2**12
 
-    if a_file_length != b_file_length:
-        print("Error files are different file lengths " + str(abs(a_file_length - b_file_length)))
+#The number of samples per channel processed at once when comparing
+compare_chunk_length = 2**16
 
-    channel_count = min(a_channel_count, b_channel_count)
-    file_length = min(a_file_length, b_file_length)
+#The number of samples per channel hashed together when checking for an exact match
+hash_block_length = 2**16
 
-    for ch in range(channel_count):
-        xcorr = np.zeros(proc_frame_length*2 - 1)
+ChannelComparison = namedtuple('ChannelComparison', ['channel', 'a_ahead_of_b', 'rms_diff'])
 
-        for frame_start in range(0, file_length, proc_frame_length // 2):
-            if frame_start+proc_frame_length < file_length:
+ExactComparison = namedtuple('ExactComparison', ['identical', 'block', 'sample', 'channel', 'rms_diff', 'reason'])
 
-                a_frame = a_wav_data[ch, frame_start:frame_start+proc_frame_length]
-                b_frame = b_wav_data[ch, frame_start:frame_start+proc_frame_length]
 
-                r = np.correlate(a_frame, b_frame, mode='full')
-                xcorr += r
+def _as_2d(wav_file):
+    if len(wav_file.shape) == 1:
+        return np.reshape(wav_file, (len(wav_file), 1))
+    return wav_file
 
-        if sum(xcorr) == 0:
-            ch_a_ahead_of_ch_b = 0
-        else:
-            ch_a_ahead_of_ch_b =  proc_frame_length - 1 - np.argmax(xcorr)
-
-        if ch_a_ahead_of_ch_b > 0:
-            print("Channel a is ahead of b by " + str(ch_a_ahead_of_ch_b) + ' samples')
-            a_start = 0
-            b_start = abs(ch_a_ahead_of_ch_b)
-            a_end = file_length - abs(ch_a_ahead_of_ch_b)
-            b_end = file_length
-        else :
-            print("Channel b is ahead of a by " + str(abs(ch_a_ahead_of_ch_b)) + ' samples')
-            a_start = abs(ch_a_ahead_of_ch_b)
-            b_start = 0
-            a_end = file_length 
-            b_end = file_length - abs(ch_a_ahead_of_ch_b)
 
-        rms_channel_diff = np.sqrt(np.sum((a_wav_data[ch, a_start:a_end] - b_wav_data[ch, b_start:b_end])**2)/(file_length - abs(ch_a_ahead_of_ch_b)))
+def estimate_lags(a_wav_file, b_wav_file, max_lag=proc_frame_length-1, chunk_length=compare_chunk_length,
+                  dtype=np.float64):
+    """ Estimates how many samples each channel of a is ahead of b.
+
+    The cross-correlation of every channel is accumulated in the frequency
+    domain one chunk at a time and searched over +/- max_lag samples. The
+    wav files are as read by scipy.io.wavfile and are converted to the float
+    dtype a chunk at a time. """
+    a_wav_file = _as_2d(a_wav_file)
+    b_wav_file = _as_2d(b_wav_file)
+    channel_count = min(a_wav_file.shape[1], b_wav_file.shape[1])
+    file_length = min(len(a_wav_file), len(b_wav_file))
+
+    fft_length = 1 << int(np.ceil(np.log2(chunk_length + max_lag)))
+    cross_spectrum = np.zeros((channel_count, fft_length // 2 + 1), dtype=np.result_type(dtype, np.complex64))
+    for chunk_start in range(0, file_length, chunk_length):
+        chunk_end = min(chunk_start + chunk_length, file_length)
+        a_chunk = audio_wav_utils.normalise_audio(a_wav_file[chunk_start:chunk_end, :channel_count].T, dtype=dtype)
+        b_chunk = audio_wav_utils.normalise_audio(b_wav_file[chunk_start:chunk_end, :channel_count].T, dtype=dtype)
+        cross_spectrum += scipy.fft.rfft(a_chunk, fft_length) * np.conj(scipy.fft.rfft(b_chunk, fft_length))
+
+    # xcorr[:, i] is the correlation of a[n + lag] with b[n] for lag = lags[i]
+    lags = np.arange(-max_lag, max_lag + 1)
+    xcorr = scipy.fft.irfft(cross_spectrum, fft_length)[:, lags % fft_length]
+
+    a_ahead_of_b = -lags[np.argmax(xcorr, axis=1)]
+    a_ahead_of_b[np.sum(xcorr, axis=1) == 0] = 0
+    return a_ahead_of_b
+
+
+def rms_differences(a_wav_file, b_wav_file, a_ahead_of_b, chunk_length=compare_chunk_length, dtype=np.float64):
+    """ Returns the RMS difference of every channel of a and b once each
+    channel has been aligned by a_ahead_of_b samples. """
+    a_wav_file = _as_2d(a_wav_file)
+    b_wav_file = _as_2d(b_wav_file)
+    channel_count = len(a_ahead_of_b)
+    file_length = min(len(a_wav_file), len(b_wav_file))
+
+    a_ahead_of_b = np.asarray(a_ahead_of_b, dtype=int)
+    a_start = np.maximum(-a_ahead_of_b, 0)
+    b_start = np.maximum(a_ahead_of_b, 0)
+    compare_length = file_length - np.abs(a_ahead_of_b)
+
+    a_channels = a_wav_file[:, :channel_count].T
+    b_channels = b_wav_file[:, :channel_count].T
+    squared_diff = np.zeros(channel_count, dtype=dtype)
+    for chunk_start in range(0, np.max(compare_length), chunk_length):
+        a_chunk = audio_wav_utils.get_frames(a_channels, [chunk_start], chunk_length, -a_start)[0]
+        b_chunk = audio_wav_utils.get_frames(b_channels, [chunk_start], chunk_length, -b_start)[0]
+        diff = audio_wav_utils.normalise_audio(a_chunk, dtype=dtype) - audio_wav_utils.normalise_audio(b_chunk, dtype=dtype)
+        in_range = chunk_start + np.arange(chunk_length) < compare_length[:, np.newaxis]
+        diff[~in_range] = 0
+        squared_diff += np.sum(diff**2, axis=1)
+
+    return np.sqrt(squared_diff / compare_length.astype(dtype))
+
 
-        if rms_channel_diff != 0 :
-            print("Ch: " + str(ch) + ' Difference: ' + str(20.*np.log10(rms_channel_diff)) + ' dB')
-            return False
+def compare_channels(a_wav_file, b_wav_file, max_lag=proc_frame_length-1, chunk_length=compare_chunk_length,
+                     dtype=np.float64):
+    """ Aligns and compares every channel of two wav files as read by
+    scipy.io.wavfile, returning a list of ChannelComparison. The work is
+    done and the RMS differences are reported in the float dtype. """
+    a_ahead_of_b = estimate_lags(a_wav_file, b_wav_file, max_lag, chunk_length, dtype)
+    rms_diff = rms_differences(a_wav_file, b_wav_file, a_ahead_of_b, chunk_length, dtype)
+    return [ChannelComparison(ch, int(a_ahead_of_b[ch]), rms_diff[ch]) for ch in range(len(a_ahead_of_b))]
+
+
+def compare(a_wav_file, b_wav_file, dtype=np.float64):
+
+    a_channel_count = audio_wav_utils.get_channel_count(a_wav_file)
+    b_channel_count = audio_wav_utils.get_channel_count(b_wav_file)
+    a_file_length = len(a_wav_file)
+    b_file_length = len(b_wav_file)
+
+    if a_channel_count != b_channel_count:
+        print("Error files are different channel counts")
+
+    if a_file_length != b_file_length:
+        print("Error files are different file lengths " + str(abs(a_file_length - b_file_length)))
+
+    all_same = True
+    for result in compare_channels(a_wav_file, b_wav_file, dtype=dtype):
+        if result.a_ahead_of_b > 0:
+            print("Channel a is ahead of b by " + str(result.a_ahead_of_b) + ' samples')
+        else :
+            print("Channel b is ahead of a by " + str(abs(result.a_ahead_of_b)) + ' samples')
+
+        if result.rms_diff != 0 :
+            print("Ch: " + str(result.channel) + ' Difference: ' + str(20.*np.log10(result.rms_diff)) + ' dB')
+            all_same = False
         else:
-            print("Ch: " + str(ch) + ' Exactly the same')
-            return True
+            print("Ch: " + str(result.channel) + ' Exactly the same')
+
+    return all_same
+
+def get_block_hashes(filename, block_length=hash_block_length, use_cache=True):
+    """ Returns the hashes of each block of raw sample data in a wav file.
+
+    The hashes are cached in a json file next to the wav and reused until
+    the wav's size or modification time changes. """
+    cache_file = str(filename) + '.blockhashes.json'
+    stat = os.stat(filename)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'block_length': block_length}
+
+    if use_cache and os.path.isfile(cache_file):
+        try:
+            cached = common_utils.json_to_dict(cache_file)
+            if cached['key'] == key:
+                return cached['hashes']
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    _, wav_file = scipy.io.wavfile.read(filename, mmap=True)
+    hashes = []
+    for block_start in range(0, len(wav_file), block_length):
+        block = np.ascontiguousarray(wav_file[block_start:block_start + block_length])
+        hashes.append(hashlib.blake2b(block, digest_size=16).hexdigest())
+    del wav_file
+
+    if use_cache:
+        try:
+            common_utils.dict_to_json({'key': key, 'hashes': hashes}, cache_file)
+        except OSError:
+            pass
+    return hashes
+
+
+def compare_exact(a_filename, b_filename, block_length=hash_block_length, use_cache=True):
+    """ Checks whether two wav files contain bit-exact sample data.
+
+    Blocks of raw samples are compared by hash, so identical files are
+    confirmed without being decoded. Only the first differing block is
+    converted to float to find the first differing sample and the RMS
+    difference of that block. reason describes any difference found. """
+    a_rate, a_wav_file = scipy.io.wavfile.read(a_filename, mmap=True)
+    b_rate, b_wav_file = scipy.io.wavfile.read(b_filename, mmap=True)
+    a_wav_file = _as_2d(a_wav_file)
+    b_wav_file = _as_2d(b_wav_file)
+
+    if a_rate != b_rate:
+        return ExactComparison(False, None, None, None, None,
+                               "sample rates differ (%d vs %d)" % (a_rate, b_rate))
+    if a_wav_file.dtype != b_wav_file.dtype:
+        return ExactComparison(False, None, None, None, None,
+                               "sample types differ (%s vs %s)" % (a_wav_file.dtype, b_wav_file.dtype))
+    if a_wav_file.shape[1] != b_wav_file.shape[1]:
+        return ExactComparison(False, None, None, None, None,
+                               "channel counts differ (%d vs %d)" % (a_wav_file.shape[1], b_wav_file.shape[1]))
+
+    a_hashes = get_block_hashes(a_filename, block_length, use_cache)
+    b_hashes = get_block_hashes(b_filename, block_length, use_cache)
+    if a_hashes == b_hashes:
+        return ExactComparison(True, None, None, None, 0.0, None)
+
+    block = next((i for i, (a_hash, b_hash) in enumerate(zip(a_hashes, b_hashes)) if a_hash != b_hash),
+                 min(len(a_hashes), len(b_hashes)))
+    block_start = block * block_length
+    block_end = min(block_start + block_length, len(a_wav_file), len(b_wav_file))
+    a_block = a_wav_file[block_start:block_end]
+    b_block = b_wav_file[block_start:block_end]
+
+    differences = np.argwhere(a_block != b_block)
+    if len(differences) == 0:
+        # The overlapping data matches but one file is longer
+        return ExactComparison(False, block, block_end, None, None,
+                               "lengths differ (%d vs %d samples)" % (len(a_wav_file), len(b_wav_file)))
+
+    sample, channel = differences[0]
+    diff = audio_wav_utils.normalise_audio(a_block) - audio_wav_utils.normalise_audio(b_block)
+    rms_diff = float(np.sqrt(np.mean(diff**2)))
+    return ExactComparison(False, block, block_start + int(sample), int(channel), rms_diff,
+                           "sample data differs")
 
 if __name__ == "__main__":
 
     args = parse_arguments()
 
-    #The number of samples of data in the frame
-    proc_frame_length = 2**12
-
-    a_rate, a_wav_file = scipy.io.wavfile.read(args.a, 'r')
-    b_rate, b_wav_file = scipy.io.wavfile.read(args.b, 'r')
+    a_rate, a_wav_file = scipy.io.wavfile.read(args.a, mmap=True)
+    b_rate, b_wav_file = scipy.io.wavfile.read(args.b, mmap=True)
 
     if a_rate != b_rate:
         print("Error files are different rates")
 
-    compare(a_wav_file, b_wav_file)
+    if args.exact:
+        result = compare_exact(args.a, args.b)
+        if result.identical:
+            print("Files are exactly the same")
+        elif result.sample is None:
+            print("Files differ: " + result.reason)
+        elif result.rms_diff is None:
+            print("Files differ from sample " + str(result.sample) + ": " + result.reason)
+        else:
+            print("Files differ from sample " + str(result.sample) + " of ch: " + str(result.channel)
+                  + ' Block difference: ' + str(20.*np.log10(result.rms_diff)) + ' dB')
+    else:
+        compare(a_wav_file, b_wav_file, np.float32 if args.float32 else np.float64)